@@ -5,35 +5,80 @@ Created on Tue Jul 24 15:46:43 2018
 @author: ABittar
 """
 
+import csv
 import os
 import sys
 
-from ehost_annotation_reader import load_mentions_with_attributes, convert_file_annotations, get_corpus_files, count_mentions
+from ehost_annotation_cache import file_fingerprint, init_worker_cache, worker_cache
+from ehost_annotation_reader import load_mentions_with_attributes, convert_file_annotations, get_corpus_files, count_mentions, FilePrefetcher
+from ehost_stats import PipelineStats
+from bisect import bisect_left
 from collections import Counter
-from sklearn.metrics import cohen_kappa_score, precision_recall_fscore_support
+from multiprocessing import Pool
 
 
-# specifies the attributes to evaluate
-ATTRS = set([])
+# fields of a mention that are never evaluated as attributes
 IGNORE_ATTRS = ['start', 'end', 'class', 'annotator', 'comment', 'text']
 
+# document store and attributes of the run a worker process of
+# batch_multi_agreement() belongs to
+MULTI_DOCS = {}
+MULTI_ATTRS = set()
 
-def get_all_annotated_attributes(files1, files2):
+
+def get_document(pin, docs=None, cache=None, stats=None, prefetcher=None):
+    """
+    Return the mentions of an annotation file, parsing it only if it is not
+    already held in the document store docs (a dictionary of file paths to
+    the output of load_mentions_with_attributes()) or in the on-disk cache.
+    prefetcher: optional FilePrefetcher to take the content of the file from
+    """
+    data = None
+    if docs is None:
+        if prefetcher is not None:
+            data = prefetcher.get(pin)
+        return load_mentions_with_attributes(pin, cache=cache, stats=stats, data=data)
+    
+    ann = docs.get(pin, None)
+    if ann is None:
+        if prefetcher is not None:
+            data = prefetcher.get(pin)
+        ann = load_mentions_with_attributes(pin, cache=cache, stats=stats, data=data)
+        docs[pin] = ann
+    
+    return ann
+
+
+def document_attributes(ann, ignore=()):
+    """
+    Return the set of attributes annotated in the output of
+    load_mentions_with_attributes() for a file.
+    ignore: attributes to leave out, in addition to IGNORE_ATTRS
+    """
+    d = convert_file_annotations(ann)
+    
+    return set(item for sublist in d for item in sublist if item not in IGNORE_ATTRS and item not in ignore)
+
+
+def get_all_annotated_attributes(files1, files2, docs=None, cache=None, ignore=(), stats=None, prefetcher=None):
     """
-    Update the set of attributes to evaluate.
+    Return the set of attributes to evaluate, i.e. all attributes annotated
+    in the given files.
+    docs: optional document store shared with count_agreements()
+    cache: optional AnnotationCache
+    ignore: attributes to leave out, in addition to IGNORE_ATTRS
+    stats: optional PipelineStats
+    prefetcher: optional FilePrefetcher reading files1 then files2 ahead
     """
-    global ATTRS
-    global IGNORE_ATTRS
+    attrs = set()
     
     for f in files1:
-        d = convert_file_annotations(load_mentions_with_attributes(f))
-        flat_list = [item for sublist in d for item in sublist if item not in IGNORE_ATTRS]
-        ATTRS = ATTRS.union(set(flat_list))
+        attrs.update(document_attributes(get_document(f, docs, cache, stats, prefetcher), ignore))
     
     for f in files2:
-        d = convert_file_annotations(load_mentions_with_attributes(f))
-        flat_list = [item for sublist in d for item in sublist if item not in IGNORE_ATTRS]
-        ATTRS = ATTRS.union(set(flat_list))
+        attrs.update(document_attributes(get_document(f, docs, cache, stats, prefetcher), ignore))
+    
+    return attrs
 
 
 def match_span(a1, a2, matching):
@@ -77,10 +122,10 @@ def match_span(a1, a2, matching):
     return False, ''
 
 
-def match_attributes(tag1, tag2):
+def match_attributes(tag1, tag2, ignore=()):
     attr_agr = {}
     
-    attrs_to_check = [a for a in tag1.keys() if a not in ['start', 'end', 'text', 'comment', 'annotator']]
+    attrs_to_check = [a for a in tag1.keys() if a not in ['start', 'end', 'text', 'comment', 'annotator'] and a not in ignore]
     
     #for a in attrs_to_check:
     #    attr_agr[a] = {'tp': 0, 'tn': 0, 'fp': 0, 'fn': 0}
@@ -128,144 +173,755 @@ def match_attributes(tag1, tag2):
     return attr_agr, match_str
 
 
-def get_tag_attrs(tag):
-    global ATTRS
+def get_tag_attrs(tag, attrs):
+    """
+    Return the values of the evaluated attributes (attrs) of a mention.
+    Attributes the mention does not have are left out, and read as None.
+    """
     values = {}
     
-    for attr in ATTRS:
-        val = tag.get(attr, None)
-        values[attr] = val
+    for attr in tag:
+        if attr in attrs:
+            values[attr] = tag[attr]
     
     return values
 
 
-def count_agreements(pin1, pin2, report_string, matching):
-    ann1 = load_mentions_with_attributes(pin1)
-    ann2 = load_mentions_with_attributes(pin2)
+def match_key(tag):
+    """
+    Hashable key for a mention, equal for any two mentions that compare
+    equal as dictionaries.
+    """
+    return frozenset(tag.items())
+
+
+def find_span_matches(spans1, spans2, matching):
+    """
+    For each (start, end) span in spans1, find the index of the first span
+    in spans2 that it matches, or None if there is no match.
+    Spans must be well-formed (start <= end), in which case a relaxed match
+    is any overlap of the two closed intervals. Relaxed candidates are found
+    by sweeping spans1 by end offset while spans2 are added by start offset
+    to a Fenwick tree holding the lowest spans2 index per end offset, which
+    takes O((n + m) log m) instead of comparing every pair.
+    """
+    if matching == 'strict':
+        first = {}
+        for j, span in enumerate(spans2):
+            first.setdefault(span, j)
+        return [first.get(span, None) for span in spans1]
     
-    tags1 = convert_file_annotations(ann1)
-    tags2 = convert_file_annotations(ann2)
+    matches = [None] * len(spans1)
+    if len(spans2) == 0:
+        return matches
     
-    matched = []
+    # Rank end offsets of spans2 in descending order so that "end >= x"
+    # becomes a prefix query
+    ends = sorted(set(e for _, e in spans2))
+    n_ends = len(ends)
+    tree = [len(spans2)] * (n_ends + 1)
     
-    tp = fp = fn = 0
+    order2 = sorted(range(len(spans2)), key=lambda j: spans2[j][0])
+    order1 = sorted(range(len(spans1)), key=lambda i: spans1[i][1])
     
-    attr_agr = {}
-    attr_vals1 = []
-    attr_vals2 = []
+    k = 0
+    for i in order1:
+        s1, e1 = spans1[i]
+        # Insert all spans2 starting at or before the end of span1
+        while k < len(order2) and spans2[order2[k]][0] <= e1:
+            j = order2[k]
+            r = n_ends - bisect_left(ends, spans2[j][1])
+            while r <= n_ends:
+                if j < tree[r]:
+                    tree[r] = j
+                r += r & -r
+            k += 1
+        # Lowest index among inserted spans2 ending at or after span1 start
+        r = n_ends - bisect_left(ends, s1)
+        best = len(spans2)
+        while r > 0:
+            if tree[r] < best:
+                best = tree[r]
+            r -= r & -r
+        if best < len(spans2):
+            matches[i] = best
     
-    report_string += '--------------------\n'
-    report_string += 'MATCHING ANNOTATIONS\n'
-    report_string += '--------------------\n'
+    return matches
+
+
+def match_spans_pairwise(tags1, tags2, matching):
+    """
+    Compare every pair of mentions with match_span(). This is only used when
+    a document contains malformed spans (end before start), for which the
+    matching conditions are not symmetric.
+    Return a list of (index1, index2, report line) tuples.
+    """
+    pairs = []
+    matched = set()
     
-    for tag1 in tags1:
-        for tag2 in tags2:
+    for i, tag1 in enumerate(tags1):
+        for j, tag2 in enumerate(tags2):
             m, r = match_span(tag1, tag2, matching)
             if m:
-                report_string += r + '\n'
-                # span
-                matched.append(tag1)
-                matched.append(tag2)
-                tp += 1
-                # attributes
-                a, r = match_attributes(tag1, tag2)
-                report_string += r
-                for attr in a:
-                    curr_agr = attr_agr.get(attr, {})
-                    new_agr = a[attr]
-                    c = dict(Counter(curr_agr) + Counter(new_agr))
-                    attr_agr[attr] = c
-                # testing
-                vals1 = get_tag_attrs(tag1)
-                vals2 = get_tag_attrs(tag2)
-                attr_vals1.append(vals1)
-                attr_vals2.append(vals2)
+                pairs.append((i, j, r))
+                matched.add(match_key(tag1))
+                matched.add(match_key(tag2))
                 break
-
-    for tag2 in tags2:
-        if tag2 not in matched:
-            for tag1 in tags1:
-                if tag1 not in matched:
+    
+    for j, tag2 in enumerate(tags2):
+        if match_key(tag2) not in matched:
+            for i, tag1 in enumerate(tags1):
+                if match_key(tag1) not in matched:
                     m, r = match_span(tag2, tag1, matching)
                     if m:
-                        report_string += r + '\n'
-                        # span
-                        matched.append(tag1)
-                        matched.append(tag2)
-                        tp += 1
-                        # attributes
-                        a, r = match_attributes(tag1, tag2)
-                        report_string += r
-                        for attr in a:
-                            curr_agr = attr_agr.get(attr, {})
-                            new_agr = a[attr]
-                            c = dict(Counter(curr_agr) + Counter(new_agr))
-                            attr_agr[attr] = c
-                        # testing
-                        vals1 = get_tag_attrs(tag1)
-                        vals2 = get_tag_attrs(tag2)
-                        attr_vals1.append(vals1)
-                        attr_vals2.append(vals2)
+                        pairs.append((i, j, r))
+                        matched.add(match_key(tag1))
+                        matched.add(match_key(tag2))
                         break
+    
+    return pairs
+
 
-    report_string += '-------------------\n'
-    report_string += 'MISSING ANNOTATIONS\n'
-    report_string += '-------------------\n'
+def count_agreements(pin1, pin2, report_string, matching, docs=None, cache=None, details=True, attrs=None, ignore=(), stats=None, class_pairs=None):
+    """
+    Match the mentions of two annotation files and append the section of the
+    report for this pair of files to report_string.
+    details: list matching, missing and spurious mentions in the report, or
+    only give their numbers
+    attrs: attributes whose values are returned for matched mentions (those annotated in either file if None)
+    ignore: attributes to leave out of the comparison
+    stats: optional PipelineStats to add the matching time and numbers of pairs compared and matches found to
+    class_pairs: optional Counter to add the (class1, class2) pair of each matched mention to, with None as class2 for missing mentions and as class1 for spurious mentions
+    """
+    ann1 = get_document(pin1, docs, cache, stats)
+    ann2 = get_document(pin2, docs, cache, stats)
+    
+    if stats is not None:
+        stats.start('matching')
+    
+    if attrs is None:
+        attrs = document_attributes(ann1, ignore).union(document_attributes(ann2, ignore))
+    
+    tags1 = convert_file_annotations(ann1)
+    tags2 = convert_file_annotations(ann2)
+    
+    spans1 = [(int(tag['start']), int(tag['end'])) for tag in tags1]
+    spans2 = [(int(tag['start']), int(tag['end'])) for tag in tags2]
+    
+    if all(s <= e for s, e in spans1) and all(s <= e for s, e in spans2):
+        # Matching is symmetric for well-formed spans, so a mention from the
+        # second set can never match a mention left unmatched by this pass
+        pairs = []
+        for i, j in enumerate(find_span_matches(spans1, spans2, matching)):
+            if j is not None:
+                r = '{} {} {}\n{} {} {}'.format(spans1[i][0], spans1[i][1], tags1[i]['text'], spans2[j][0], spans2[j][1], tags2[j]['text'])
+                pairs.append((i, j, r))
+    else:
+        pairs = match_spans_pairwise(tags1, tags2, matching)
+    
+    matched = set()
+    
+    tp = fp = fn = 0
+    
+    attr_agr = {}
+    attr_vals1 = []
+    attr_vals2 = []
+    
+    # The section is collected in a list and joined once
+    report = [report_string]
+    
+    if details:
+        report.append('--------------------\n')
+        report.append('MATCHING ANNOTATIONS\n')
+        report.append('--------------------\n')
+    
+    for i, j, r in pairs:
+        tag1 = tags1[i]
+        tag2 = tags2[j]
+        if details:
+            report.append(r + '\n')
+        # span
+        matched.add(match_key(tag1))
+        matched.add(match_key(tag2))
+        tp += 1
+        if class_pairs is not None:
+            class_pairs[(tag1['class'], tag2['class'])] += 1
+        # attributes
+        a, r = match_attributes(tag1, tag2, ignore)
+        if details:
+            report.append(r)
+        for attr in a:
+            curr_agr = attr_agr.get(attr, {})
+            new_agr = a[attr]
+            c = dict(Counter(curr_agr) + Counter(new_agr))
+            attr_agr[attr] = c
+        # testing
+        vals1 = get_tag_attrs(tag1, attrs)
+        vals2 = get_tag_attrs(tag2, attrs)
+        attr_vals1.append(vals1)
+        attr_vals2.append(vals2)
+
+    if details:
+        report.append('-------------------\n')
+        report.append('MISSING ANNOTATIONS\n')
+        report.append('-------------------\n')
     for tag1 in tags1:
-        if tag1 not in matched:
-            report_string += str(tag1['start']) + ' ' + str(tag1['end']) + ' ' + str(tag1['text']) + '\n'
+        if match_key(tag1) not in matched:
+            if details:
+                report.append(str(tag1['start']) + ' ' + str(tag1['end']) + ' ' + str(tag1['text']) + '\n')
             fn += 1
+            if class_pairs is not None:
+                class_pairs[(tag1['class'], None)] += 1
 
-    report_string += '--------------------\n'
-    report_string += 'SPURIOUS ANNOTATIONS\n'
-    report_string += '--------------------\n'
+    if details:
+        report.append('--------------------\n')
+        report.append('SPURIOUS ANNOTATIONS\n')
+        report.append('--------------------\n')
     for tag2 in tags2:
-        if tag2 not in matched:
-            report_string += str(tag2['start']) + ' ' + str(tag2['end']) + ' ' + str(tag2['text']) + '\n'
+        if match_key(tag2) not in matched:
+            if details:
+                report.append(str(tag2['start']) + ' ' + str(tag2['end']) + ' ' + str(tag2['text']) + '\n')
             fp += 1
+            if class_pairs is not None:
+                class_pairs[(None, tag2['class'])] += 1
+    
+    if not details:
+        report.append('matching: ' + str(tp) + ', missing: ' + str(fn) + ', spurious: ' + str(fp) + '\n')
+    report.append('==========\n')
     
-    report_string += '==========\n'
+    if stats is not None:
+        stats.stop()
+        stats.count('pairs_compared')
+        stats.count('mentions_compared', len(tags1) + len(tags2))
+        stats.count('matches_found', tp)
 
-    return tp, fp, fn, attr_agr, attr_vals1, attr_vals2, report_string
+    return tp, fp, fn, attr_agr, attr_vals1, attr_vals2, ''.join(report)
 
 
 def attr_prf(attr_agr_g, report_string):
     """
     Hand-coded calculations
     """
+    report = [report_string]
+    
     # Using my metric - gives the same results as scikit-learn
     for attr in attr_agr_g:
-        report_string += '-- ' + attr + '\n'
+        report.append('-- ' + attr + '\n')
         tp = attr_agr_g[attr].get('tp', 0.0)
         fp = attr_agr_g[attr].get('fp', 0.0)
         #tn = attr_agr_g[attr].get('tn', 0.0)
         fn = attr_agr_g[attr].get('fn', 0.0)
         p, r, f = prf(tp, fp, fn)
-        report_string += '\tprecision: ' + str(p) + '\n'
-        report_string += '\trecall   : ' + str(r) + '\n'
-        report_string += '\tf-score  : ' + str(f) + '\n'
+        report.append('\tprecision: ' + str(p) + '\n')
+        report.append('\trecall   : ' + str(r) + '\n')
+        report.append('\tf-score  : ' + str(f) + '\n')
 
-    return report_string
+    return ''.join(report)
 
 
-def prf(tp, fp, fn):
-    print('-- Calculating precision, recall and f-score')
-    print('   tp:', tp)
-    print('   fp:', fp)
-    print('   fn:', fn)
+def attribute_value_counts(attr_vals1, attr_vals2, counts=None):
+    """
+    Count the pairs of values of each attribute over matched mentions in a
+    single pass, adding them to counts (a dictionary of attribute names to
+    Counters of (value1, value2) tuples) if given.
+    Only non-missing values are visited: pairs of missing values are left
+    out and derived from the number of matched mentions by
+    confusion_matrices().
+    """
+    if counts is None:
+        counts = {}
+    
+    for vals1, vals2 in zip(attr_vals1, attr_vals2):
+        for attr, val1 in vals1.items():
+            if val1 is not None:
+                c = counts.get(attr, None)
+                if c is None:
+                    c = counts[attr] = Counter()
+                c[(val1, vals2.get(attr, None))] += 1
+        for attr, val2 in vals2.items():
+            if val2 is not None and vals1.get(attr, None) is None:
+                c = counts.get(attr, None)
+                if c is None:
+                    c = counts[attr] = Counter()
+                c[(None, val2)] += 1
+    
+    return counts
+
+
+def confusion_matrices(counts, n, attrs):
+    """
+    Build the confusion matrix of each attribute from the value pair counts
+    of attribute_value_counts() over n matched mentions, and return a
+    dictionary of attribute names to (labels, confusion matrix) tuples.
+    Rows are the values of the first annotator and columns those of the
+    second. Missing values are counted as None, which is the first label
+    whenever it occurs.
+    """
+    import numpy as np
+    
+    matrices = {}
+    for attr in attrs:
+        c = Counter(counts.get(attr, {}))
+        n_missing = n - sum(c.values())
+        if n_missing > 0:
+            c[(None, None)] = n_missing
+        
+        values = set()
+        for val1, val2 in c:
+            values.add(val1)
+            values.add(val2)
+        labels = sorted(v for v in values if v is not None)
+        if None in values:
+            labels = [None] + labels
+        
+        codes = {}
+        for i, label in enumerate(labels):
+            codes[label] = i
+        
+        pair_codes = np.array([(codes[val1], codes[val2]) for val1, val2 in c], dtype=np.int64).reshape(-1, 2)
+        confusion = np.zeros((len(labels), len(labels)), dtype=np.int64)
+        np.add.at(confusion, (pair_codes[:, 0], pair_codes[:, 1]), np.array(list(c.values()), dtype=np.int64))
+        matrices[attr] = (labels, confusion)
+    
+    return matrices
+
+
+def attribute_confusion_matrices(attr_vals1, attr_vals2, attrs):
+    """
+    Return the confusion matrices of the values of each attribute over all
+    matched mentions (see confusion_matrices()).
+    """
+    return confusion_matrices(attribute_value_counts(attr_vals1, attr_vals2), len(attr_vals1), attrs)
+
+
+def confusion_prf(confusion, average):
+    """
+    Precision, recall and f-score from a confusion matrix, averaged over
+    labels ('macro') or computed from global counts ('micro'). Undefined
+    ratios are set to 0, as scikit-learn does.
+    """
+    import numpy as np
+    
+    if confusion.sum() == 0:
+        return float('nan'), float('nan'), float('nan')
+    
+    tp = np.diag(confusion)
+    pred = confusion.sum(axis=0)
+    true = confusion.sum(axis=1)
+    
+    if average == 'micro':
+        tp = tp.sum().reshape(1)
+        pred = pred.sum().reshape(1)
+        true = true.sum().reshape(1)
+    
+    def divide(num, denom):
+        num = num.astype(np.float64)
+        denom = denom.astype(np.float64)
+        result = num / np.where(denom == 0, 1.0, denom)
+        result[denom == 0] = 0.0
+        return result
+    
+    p = divide(tp, pred)
+    r = divide(tp, true)
+    f = divide(2.0 * tp, 1.0 * true + pred)
+    
+    return float(np.average(p)), float(np.average(r)), float(np.average(f))
+
+
+def confusion_kappa(confusion):
+    """
+    Cohen's kappa from a confusion matrix (nan if undefined).
+    """
+    import numpy as np
+    
+    confusion = confusion.astype(np.float64)
+    sum0 = confusion.sum(axis=0)
+    sum1 = confusion.sum(axis=1)
+    
+    total = np.sum(sum0)
+    if total == 0:
+        return float('nan')
+    expected = np.outer(sum0, sum1) / total
+    
+    w_mat = np.ones(confusion.shape, dtype=np.float64)
+    np.fill_diagonal(w_mat, 0)
+    
+    denom = np.sum(w_mat * expected)
+    if denom == 0:
+        return float('nan')
+    
+    return float(1 - np.sum(w_mat * confusion) / denom)
+
+
+def class_prf(class_pairs):
+    """
+    Per-class span agreement from the class pairs counted by
+    count_agreements(). A span matched with a different class is a missing
+    mention of the class of the first annotator and a spurious mention of
+    the class of the second.
+    Return a dictionary of classes to dictionaries of tp, fp, fn,
+    precision, recall and f-score.
+    """
+    counts = {}
+    for (class1, class2), n in class_pairs.items():
+        if class1 is not None:
+            counts.setdefault(class1, Counter())['tp' if class1 == class2 else 'fn'] += n
+        if class2 is not None and class2 != class1:
+            counts.setdefault(class2, Counter())['fp'] += n
+    
+    scores = {}
+    for c in sorted(counts):
+        tp, fp, fn = counts[c]['tp'], counts[c]['fp'], counts[c]['fn']
+        p, r, f = prf(tp, fp, fn)
+        scores[c] = { 'tp': tp, 'fp': fp, 'fn': fn, 'precision': p, 'recall': r, 'f-score': f }
+    
+    return scores
+
+
+def class_confusion_matrix(class_pairs):
+    """
+    Confusion matrix of the classes of matched spans, from the class pairs
+    counted by count_agreements(). Rows are the classes of the first
+    annotator and columns those of the second.
+    Return the labels and the matrix as a list of rows.
+    """
+    labels = sorted(set(c for pair in class_pairs for c in pair if c is not None))
+    index = {}
+    for i, label in enumerate(labels):
+        index[label] = i
+    
+    matrix = [[0] * len(labels) for _ in labels]
+    for (class1, class2), n in class_pairs.items():
+        if class1 is not None and class2 is not None:
+            matrix[index[class1]][index[class2]] += n
+    
+    return labels, matrix
+
+
+def prf(tp, fp, fn, verbose=False):
+    """
+    Precision, recall and f-score from global counts.
+    verbose: print the counts
+    """
+    if verbose:
+        print('-- Calculating precision, recall and f-score')
+        print('   tp:', tp)
+        print('   fp:', fp)
+        print('   fn:', fn)
 
     if tp + fp == 0.0 or tp + fn == 0.0:
-        print('-- Warning: cannot calculate metrics with zero denominator')
+        if verbose:
+            print('-- Warning: cannot calculate metrics with zero denominator')
         return 0.0, 0.0, 0.0
 
     p = tp / (tp + fp)
     r = tp / (tp + fn)
-    f = 2 * p * r / (p + r)
-    
+    f = 0.0
+    if p + r > 0.0:
+        f = 2 * p * r / (p + r)
+
     return p, r, f
 
 
-def batch_agreement(ann_dir1, ann_dir2, report_dir=None, matching='relaxed', compare_attributes=True, ignore_attributes=[]):
+def bootstrap_matrix(partials, attrs):
+    """
+    Arrange the partial results of the document pairs of a run (see
+    score_pair()) as a matrix with a row per document, for
+    bootstrap_agreement(). The columns are tp, fp and fn, followed by the
+    flattened confusion matrix of each attribute (see confusion_matrices()).
+    Return the matrix and a list of (attribute, number of labels, first
+    column) tuples.
+    """
+    import numpy as np
+    
+    columns = []
+    n_cols = 3
+    for attr in sorted(attrs):
+        # The same labels for every document, i.e. those of the whole run
+        counts = Counter()
+        n_matched = 0
+        for pair_result in partials:
+            counts.update(pair_result['attr_counts'].get(attr, {}))
+            n_matched += pair_result['n_matched']
+        labels = confusion_matrices({ attr: counts }, n_matched, [attr])[attr][0]
+        columns.append((attr, len(labels), n_cols, labels))
+        n_cols += len(labels) * len(labels)
+    
+    matrix = np.zeros((len(partials), n_cols), dtype=np.float64)
+    for i, pair_result in enumerate(partials):
+        matrix[i, :3] = (pair_result['tp'], pair_result['fp'], pair_result['fn'])
+        for attr, n_labels, col, labels in columns:
+            codes = {}
+            for j, label in enumerate(labels):
+                codes[label] = j
+            c = pair_result['attr_counts'].get(attr, {})
+            n_missing = pair_result['n_matched'] - sum(c.values())
+            if n_missing > 0:
+                matrix[i, col] += n_missing
+            for (val1, val2), n in c.items():
+                matrix[i, col + codes[val1] * n_labels + codes[val2]] += n
+    
+    return matrix, [(attr, n_labels, col) for attr, n_labels, col, _ in columns]
+
+
+def bootstrap_scores(totals, columns):
+    """
+    Span precision, recall and f-score and the kappa of each attribute for
+    every row of totals (resampled sums of the rows of bootstrap_matrix()).
+    Return an array with a row per resample and a column per score.
+    """
+    import numpy as np
+    
+    scores = np.empty((totals.shape[0], 3 + len(columns)), dtype=np.float64)
+    tp, fp, fn = totals[:, 0], totals[:, 1], totals[:, 2]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        # As prf(), scores are 0 if a denominator is 0
+        defined = (tp + fp > 0) & (tp + fn > 0)
+        p = np.where(defined, tp / (tp + fp), 0.0)
+        r = np.where(defined, tp / (tp + fn), 0.0)
+        scores[:, 0] = p
+        scores[:, 1] = r
+        scores[:, 2] = np.where(p + r > 0, 2 * p * r / (p + r), 0.0)
+        
+        # As confusion_kappa(), vectorized over resamples
+        for k, (attr, n_labels, col) in enumerate(columns):
+            confusion = totals[:, col:col + n_labels * n_labels].reshape(-1, n_labels, n_labels)
+            total = confusion.sum(axis=(1, 2))
+            observed = total - np.trace(confusion, axis1=1, axis2=2)
+            expected = total - (confusion.sum(axis=1) * confusion.sum(axis=2)).sum(axis=1) / total
+            scores[:, 3 + k] = np.where((total > 0) & (expected != 0), 1 - observed / expected, np.nan)
+    
+    return scores
+
+
+def bootstrap_chunk(args):
+    """
+    Score n resamples of the documents of a bootstrap_matrix(). Takes a
+    (matrix, columns, seed sequence, n) tuple, to be run in worker
+    processes.
+    """
+    import numpy as np
+    
+    matrix, columns, seed, n = args
+    rng = np.random.default_rng(seed)
+    n_docs = matrix.shape[0]
+    # Number of times each document is drawn in each resample
+    weights = rng.multinomial(n_docs, np.full(n_docs, 1.0 / n_docs), size=n)
+    
+    return bootstrap_scores(weights.astype(np.float64) @ matrix, columns)
+
+
+# number of resamples scored by each bootstrap task
+BOOTSTRAP_CHUNK_SIZE = 100
+
+
+def bootstrap_agreement(partials, attrs=(), n_resamples=1000, alpha=0.05, seed=None, workers=1):
+    """
+    Document-level bootstrap confidence intervals for span precision, recall
+    and f-score and the kappa of each attribute. Documents (pairs of files)
+    are resampled with replacement and the partial counts of the scoring
+    pass are summed for each resample, so no document is scored again.
+    partials: partial results of each pair of files (see score_pair())
+    attrs: attributes whose kappa is resampled
+    n_resamples: number of resamples
+    alpha: the intervals are the alpha / 2 and 1 - alpha / 2 percentiles
+    seed: random seed; the same seed gives the same intervals whatever the number of workers
+    workers: number of processes (on platforms that spawn processes, call from within an if __name__ == '__main__' block)
+    Return a dictionary with the number of resamples and documents, alpha,
+    the seed (the entropy drawn if seed is None), 'spans' (a (low, high)
+    tuple for precision, recall and f-score) and 'attributes' (a dictionary
+    of attributes to a dictionary with a (low, high) tuple for kappa).
+    Resamples in which kappa is undefined are left out.
+    """
+    import numpy as np
+    
+    matrix, columns = bootstrap_matrix(partials, attrs)
+    seed_seq = np.random.SeedSequence(seed)
+    
+    # Chunks only depend on the number of resamples, so that a seed gives
+    # the same resamples whatever the number of workers
+    sizes = [min(BOOTSTRAP_CHUNK_SIZE, n_resamples - i) for i in range(0, n_resamples, BOOTSTRAP_CHUNK_SIZE)]
+    tasks = [(matrix, columns, s, n) for s, n in zip(seed_seq.spawn(len(sizes)), sizes)]
+    
+    if len(partials) == 0:
+        scores = np.full((0, 3 + len(columns)), np.nan)
+    elif workers > 1 and len(tasks) > 1:
+        with Pool(processes=min(workers, len(tasks))) as pool:
+            scores = np.concatenate(pool.map(bootstrap_chunk, tasks))
+    else:
+        scores = np.concatenate([bootstrap_chunk(task) for task in tasks])
+    
+    def interval(values):
+        values = values[~np.isnan(values)]
+        if len(values) == 0:
+            return float('nan'), float('nan')
+        low, high = np.percentile(values, [100.0 * alpha / 2, 100.0 * (1 - alpha / 2)])
+        return float(low), float(high)
+    
+    results = { 'n_resamples': n_resamples,
+                'n_docs': len(partials),
+                'alpha': alpha,
+                'seed': seed_seq.entropy,
+                'spans': { 'precision': interval(scores[:, 0]),
+                           'recall': interval(scores[:, 1]),
+                           'f-score': interval(scores[:, 2]) },
+                'attributes': {}
+                }
+    for k, (attr, _, _) in enumerate(columns):
+        results['attributes'][attr] = { 'kappa': interval(scores[:, 3 + k]) }
+    
+    return results
+
+
+def score_pair(f1, f2, matching, docs, cache=None, details=True, ignore=(), stats=None):
+    """
+    Score a pair of files for batch_agreement().
+    Return the attributes annotated in the pair and the partial results
+    that batch_agreement() adds up: tp, fp, fn, class_pairs (see
+    count_agreements()), attr_agr, attr_counts (see
+    attribute_value_counts()), n_matched and the report section.
+    """
+    attrs = get_all_annotated_attributes([f1], [f2], docs, cache, ignore, stats)
+    
+    class_pairs = Counter()
+    tp, fp, fn, attr_agr, attr_vals1, attr_vals2, r = count_agreements(f1, f2, '', matching, docs, cache, details, attrs, ignore, stats, class_pairs)
+    
+    if stats is not None:
+        stats.start('attributes')
+    
+    pair_result = { 'tp': tp,
+                'fp': fp,
+                'fn': fn,
+                'class_pairs': class_pairs,
+                'attr_agr': attr_agr,
+                'attr_counts': attribute_value_counts(attr_vals1, attr_vals2),
+                'n_matched': len(attr_vals1),
+                'report': r
+                }
+    
+    if stats is not None:
+        stats.stop()
+    
+    return attrs, pair_result
+
+
+def score_file_pair(args):
+    """
+    Score a single (file1, file2, matching, cache, details, ignore,
+    collect_stats) pair in a worker process. A cache of None stands for the
+    one shared with the worker process by init_worker_cache(), if any.
+    Return the output of score_pair(), the cache hits and misses and, if
+    collect_stats is True, the worker's PipelineStats as a dictionary.
+    """
+    f1, f2, matching, cache, details, ignore, collect_stats = args
+    if cache is None:
+        cache = worker_cache()
+    docs = {}
+    hits = misses = 0
+    if cache is not None:
+        hits, misses = cache.hits, cache.misses
+    stats = None
+    if collect_stats:
+        stats = PipelineStats()
+    
+    attrs, pair_result = score_pair(f1, f2, matching, docs, cache, details, ignore, stats)
+    
+    if cache is not None:
+        hits, misses = cache.hits - hits, cache.misses - misses
+    if stats is not None:
+        stats = stats.to_dict()
+    
+    return attrs, pair_result, (hits, misses), stats
+
+
+def pair_files(files1, dir1, files2, dir2):
+    """
+    Pair annotation files of two corpora through an index rather than by
+    comparing every pair of file names.
+    Files are paired on their path relative to the corpus directory
+    (<patient>/saved/<file>). Files without such a counterpart are paired on
+    their base name, as long as that name occurs only once in each corpus.
+    Return the list of (file1, file2) pairs in the order of files1, and the
+    lists of unpaired files from each corpus.
+    """
+    rel_index2 = {}
+    base_index2 = {}
+    for f2 in files2:
+        rel_index2.setdefault(os.path.relpath(f2, dir2), f2)
+        base_index2.setdefault(os.path.basename(f2), []).append(f2)
+
+    base_counts1 = Counter(os.path.basename(f1) for f1 in files1)
+
+    pairs = []
+    paired2 = set()
+    unpaired1 = []
+    for f1 in files1:
+        f2 = rel_index2.get(os.path.relpath(f1, dir1), None)
+        if f2 is None:
+            f1b = os.path.basename(f1)
+            candidates = base_index2.get(f1b, [])
+            if len(candidates) == 1 and base_counts1[f1b] == 1:
+                f2 = candidates[0]
+        if f2 is None or f2 in paired2:
+            unpaired1.append(f1)
+            continue
+        pairs.append((f1, f2))
+        paired2.add(f2)
+
+    unpaired2 = [f2 for f2 in files2 if f2 not in paired2]
+
+    return pairs, unpaired1, unpaired2
+
+
+class ReportWriter(object):
+    """
+    Write an agreement report section by section to standard output and/or
+    a buffered file as it is produced, instead of holding it in memory.
+    Used as a context manager, it closes the file on exit and deletes it if
+    an error occurred, rather than leaving an incomplete report.
+    """
+
+    def __init__(self, pout=None, echo=True, buffer_size=1024 * 1024, stats=None):
+        self.pout = pout
+        self.echo = echo
+        self.fout = None
+        self.stats = stats
+        if pout is not None:
+            self.fout = open(pout, 'w', buffering=buffer_size)
+
+    def write(self, s):
+        if self.stats is not None:
+            self.stats.start('report')
+        if self.echo:
+            sys.stdout.write(s)
+        if self.fout is not None:
+            self.fout.write(s)
+        if self.stats is not None:
+            self.stats.stop()
+
+    def close(self):
+        if self.echo:
+            # Final line break, as when the whole report was printed at once
+            sys.stdout.write('\n')
+            sys.stdout.flush()
+        if self.fout is not None:
+            self.fout.close()
+            self.fout = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        elif self.fout is not None:
+            self.fout.close()
+            self.fout = None
+            os.remove(self.pout)
+        return False
+
+
+def batch_agreement(ann_dir1, ann_dir2, report_dir=None, matching='relaxed', compare_attributes=True, ignore_attributes=[], workers=1, cache=None, report_details=True, print_report=True, results_store=None, stats=None, compare_classes=True, io_workers=0, max_in_flight=32, bootstrap=0, alpha=0.05, seed=None):
     """
     ann_dir_1 and ann_dir_2 are tuples of the form:
         ('Annotator1_Name','Dir_1')
@@ -274,9 +930,22 @@ def batch_agreement(ann_dir1, ann_dir2, report_dir=None, matching='relaxed', com
     matching: specifies whether spans must be strict matches (strict) or partial matches (relaxed)
     compare_attributes: calculate agreement for span attributes (True/False)
     ignore_attributes: list of attributes to ignore
+    workers: number of processes used to score pairs of files (on platforms that spawn processes, call from within an if __name__ == '__main__' block)
+    cache: optional AnnotationCache to reuse annotations parsed in earlier runs
+    report_details: list matching, missing and spurious mentions for each pair of files, or only give their numbers
+    print_report: also write the report to standard output
+    results_store: optional PairResultStore holding the results of earlier runs, so that only pairs in which a file was added or changed are scored again
+    stats: optional PipelineStats to collect the time per stage (discovery, parsing, matching, attributes, metrics, report) and counts of files, bytes, mentions, pairs and matches, which are also printed to standard error
+    compare_classes: calculate span agreement for each mention class and the confusion matrix of the classes of matched spans (True/False)
+    io_workers: number of threads listing directories and, when pairs are scored in this process, reading files ahead of parsing, for file systems with a high latency per request such as network shares (files are read when parsed if 0)
+    max_in_flight: maximum number of files read ahead (see FilePrefetcher)
+    bootstrap: number of document resamples for confidence intervals of the span scores and attribute kappas, computed with workers processes (no intervals if 0, see bootstrap_agreement())
+    alpha: significance level of the confidence intervals, e.g. 0.05 for 95% intervals
+    seed: random seed of the resamples
+    All state of a run is local to the call, so independent runs can
+    execute concurrently in threads and share a cache and results store.
+    Return a dictionary of the results in the report: 'spans' (tp, fp, fn, precision, recall, f-score), 'classes' (the same for each class, see class_prf()), 'class_confusion' (labels and matrix, see class_confusion_matrix()) and 'attributes' (macro and micro precision, recall and f-score and kappa for each attribute), with confidence intervals under 'ci' and 'kappa_ci' and the bootstrap parameters under 'bootstrap' if bootstrap is not 0.
     """
-    global ATTRS
-    
     if matching not in ['strict', 'relaxed']:
         raise ValueError('-- Invalid matching type "' + str(matching) + '". Use "strict" or "relaxed".')
     
@@ -289,100 +958,513 @@ def batch_agreement(ann_dir1, ann_dir2, report_dir=None, matching='relaxed', com
     ann2 = ann_dir2[0]
     dir2 = ann_dir2[1]
     
-    files1 = [f for f in get_corpus_files(dir1) if f.endswith('xml')]
-    files2 = [f for f in get_corpus_files(dir2) if f.endswith('xml')]
-    
-    # Get all annotated attributes - need to do this here
-    get_all_annotated_attributes(files1, files2)
+    files1 = [f for f in get_corpus_files(dir1, stats=stats, io_workers=max(1, io_workers)) if f.endswith('xml')]
+    files2 = [f for f in get_corpus_files(dir2, stats=stats, io_workers=max(1, io_workers)) if f.endswith('xml')]
     
     #print(files1)
     #print('---')
     #print(files2)
     
+    pout = None
     if report_dir is not None:
         pout = os.path.join(report_dir, 'agreement_report_' + ann1 + '_' + ann2 + '.txt')
-        fout = open(pout, 'w')
-    
-    report_string =  '================================\n'
-    report_string += 'INTER-ANNOTATOR AGREEMENT REPORT\n'
-    report_string += '================================\n'
+    with ReportWriter(pout, echo=print_report, stats=stats) as report:
+        report.write('================================\n')
+        report.write('INTER-ANNOTATOR AGREEMENT REPORT\n')
+        report.write('================================\n')
 
-    report_string += 'Input1 (' + ann1 + '): ' + dir1 + '\n'
-    report_string += 'Input2 (' + ann2 + '): ' + dir2 + '\n'
-    report_string += 'Matching: ' + matching + '\n'
-    report_string += '-------------------------\n'
+        report.write('Input1 (' + ann1 + '): ' + dir1 + '\n')
+        report.write('Input2 (' + ann2 + '): ' + dir2 + '\n')
+        report.write('Matching: ' + matching + '\n')
 
-    tp_g = fp_g = fn_g = 0.0
-    
-    attr_agr_g = {}
-    attr_vals1_g = []
-    attr_vals2_g = []
-    
-    for f1 in files1:
-        for f2 in files2:
-            # Only compare files that are in both sets
-            f1b = os.path.basename(f1)
-            f2b = os.path.basename(f2)
-            if f1b == f2b:
-                report_string += 'File1: ' + f1 + '\n'
-                report_string += 'File2: ' + f2 + '\n'
-                tp, fp, fn, attr_agr, attr_vals1, attr_vals2, report_string = count_agreements(f1, f2, report_string, matching)
-                tp_g += tp
-                fp_g += fp
-                fn_g += fn
+        # Only compare files that are in both sets
+        if stats is not None:
+            stats.start('discovery')
+        pairs, unpaired1, unpaired2 = pair_files(files1, dir1, files2, dir2)
+        if stats is not None:
+            stats.stop()
+
+        # Each pair of files is parsed once, shared by attribute discovery and
+        # matching, and discarded once it is scored. Attributes only need to be
+        # known before the metrics are computed, so they are collected pair by
+        # pair.
+        docs = {}
+        attrs_g = set()
+        ignore = set(ignore_attributes)
+
+        report.write('Paired files: ' + str(len(pairs)) + '\n')
+        report.write('Unpaired files (' + ann1 + '): ' + str(len(unpaired1)) + '\n')
+        report.write('Unpaired files (' + ann2 + '): ' + str(len(unpaired2)) + '\n')
+        report.write('-------------------------\n')
+
+        tp_g = fp_g = fn_g = 0.0
+        class_pairs_g = Counter()
+
+        attr_agr_g = {}
+        attr_counts_g = {}
+        n_matched_g = 0
+        
+        # Counts of each pair, resampled for the confidence intervals
+        partials = []
+
+        # Only pairs without a stored result for the current files are scored
+        params = matching + ':' + ('details' if report_details else 'summary')
+        if len(ignore) > 0:
+            params += ':ignore=' + ','.join(sorted(ignore))
+        rescore = []
+        fingerprints = {}
+        for f1, f2 in pairs:
+            if results_store is None or not results_store.contains(f1, f2, params):
+                rescore.append((f1, f2))
+                if results_store is not None:
+                    fingerprints[(f1, f2)] = (file_fingerprint(f1), file_fingerprint(f2))
+
+        # Pairs are scored in parallel but merged in input order, so that the
+        # report is identical to that of a serial run
+        pool = None
+        results = None
+        prefetcher = None
+        if workers > 1 and len(rescore) > 0:
+            # The cache is sent to each process once, not with every pair
+            pool = Pool(processes=workers, initializer=init_worker_cache, initargs=(cache,))
+            chunksize = max(1, len(rescore) // (4 * workers))
+            results = pool.imap(score_file_pair, [(f1, f2, matching, None, report_details, ignore, stats is not None) for f1, f2 in rescore], chunksize)
+        elif io_workers > 0 and len(rescore) > 0:
+            # Files of the following pairs are read while the current one is scored
+            prefetcher = FilePrefetcher([f for pair in rescore for f in pair], io_workers, max_in_flight, cache=cache)
+        rescore = set(rescore)
+
+        try:
+            for f1, f2 in pairs:
+                report.write('File1: ' + f1 + '\n')
+                report.write('File2: ' + f2 + '\n')
+                stored = None
+                if (f1, f2) not in rescore:
+                    stored = results_store.get(f1, f2, params)
+                if stored is not None:
+                    attrs, pair_result = stored
+                    if stats is not None:
+                        stats.count('pairs_reused')
+                elif results is not None and (f1, f2) in rescore:
+                    attrs, pair_result, cache_stats, worker_stats = next(results)
+                    if cache is not None:
+                        cache.add_stats(*cache_stats)
+                    if stats is not None:
+                        stats.merge(worker_stats)
+                else:
+                    if results_store is not None and (f1, f2) not in fingerprints:
+                        # Changed since it was checked
+                        fingerprints[(f1, f2)] = (file_fingerprint(f1), file_fingerprint(f2))
+                    if prefetcher is not None:
+                        get_document(f1, docs, cache, stats, prefetcher)
+                        get_document(f2, docs, cache, stats, prefetcher)
+                    attrs, pair_result = score_pair(f1, f2, matching, docs, cache, report_details, ignore, stats)
+                    docs.pop(f1, None)
+                    docs.pop(f2, None)
+                if results_store is not None and stored is None:
+                    results_store.put(f1, f2, params, fingerprints[(f1, f2)], (attrs, pair_result))
+            
+                attrs_g.update(attrs)
+                report.write(pair_result['report'])
+                tp_g += pair_result['tp']
+                fp_g += pair_result['fp']
+                fn_g += pair_result['fn']
+                class_pairs_g.update(pair_result['class_pairs'])
+                attr_agr = pair_result['attr_agr']
                 for attr in attr_agr:
                     curr_agr = attr_agr_g.get(attr, {})
                     new_agr = attr_agr[attr]
                     c = dict(Counter(curr_agr) + Counter(new_agr))
                     attr_agr_g[attr] = c
-                
-                # Used for scikit-learn calculations
-                attr_vals1_g.extend(attr_vals1)
-                attr_vals2_g.extend(attr_vals2)
-
-    assert len(attr_vals1_g) == len(attr_vals2_g)
-    
-    report_string += '\n'
-    report_string += 'SPANS\n'
-    report_string += '-----\n'
 
-    p, r, f = prf(tp_g, fp_g, fn_g)
+                # Used for the attribute confusion matrices
+                for attr in pair_result['attr_counts']:
+                    attr_counts_g.setdefault(attr, Counter()).update(pair_result['attr_counts'][attr])
+                n_matched_g += pair_result['n_matched']
+            
+                if bootstrap > 0:
+                    partials.append({ 'tp': pair_result['tp'],
+                                      'fp': pair_result['fp'],
+                                      'fn': pair_result['fn'],
+                                      'attr_counts': pair_result['attr_counts'],
+                                      'n_matched': pair_result['n_matched']
+                                      })
+        finally:
+            if prefetcher is not None:
+                prefetcher.close()
+            if pool is not None:
+                # All results are merged unless an error occurred, in which
+                # case the workers still running are stopped
+                pool.terminate()
+                pool.join()
 
-    report_string += 'precision: ' + str(p) + '\n'
-    report_string += 'recall   : ' + str(r) + '\n'
-    report_string += 'f-score  : ' + str(f) + '\n'
-
-    # Using scikit-learn (per-class results)
-    if compare_attributes:
-        report_string += '\n'
-        report_string += 'ATTRIBUTES\n'
-        report_string += '----------\n'
+        if results_store is not None:
+            results_store.prune(pairs, params)
         
-        if len(ATTRS) == 0:
-            report_string += '-- No attributes to compare\n'
+        ci = None
+        if bootstrap > 0:
+            if stats is not None:
+                stats.start('bootstrap')
+            ci = bootstrap_agreement(partials, attrs_g if compare_attributes else (), bootstrap, alpha, seed, workers)
+            if stats is not None:
+                stats.stop()
         
-        for attr in sorted(ATTRS):
-            report_string += '-- ' + attr + '\n'
-            sample1 = [k.get(attr, None) for k in attr_vals1_g]
-            sample2 = [k.get(attr, None) for k in attr_vals2_g]
+        report.write('\n')
+        report.write('SPANS\n')
+        report.write('-----\n')
+
+        if stats is not None:
+            stats.start('metrics')
+        p, r, f = prf(tp_g, fp_g, fn_g)
+        if stats is not None:
+            stats.stop()
+
+        report.write('precision: ' + str(p) + '\n')
+        report.write('recall   : ' + str(r) + '\n')
+        report.write('f-score  : ' + str(f) + '\n')
+
+        results = { 'spans': { 'tp': tp_g, 'fp': fp_g, 'fn': fn_g, 'precision': p, 'recall': r, 'f-score': f } }
         
-            scores = {}
-            scores['macro'] = precision_recall_fscore_support(sample1, sample2, average='macro')
-            scores['micro'] = precision_recall_fscore_support(sample1, sample2, average='micro')
+        if ci is not None:
+            level = '{:g}'.format(100 * (1 - alpha)) + '%'
+            report.write('-- ' + level + ' confidence intervals (' + str(bootstrap) + ' resamples of ' + str(ci['n_docs']) + ' documents, seed ' + str(ci['seed']) + ')\n')
+            for score in ['precision', 'recall', 'f-score']:
+                report.write('\t' + score.ljust(9) + ': ' + str(list(ci['spans'][score])) + '\n')
+            results['spans']['ci'] = ci['spans']
+            results['bootstrap'] = { 'n_resamples': bootstrap, 'n_docs': ci['n_docs'], 'alpha': alpha, 'seed': ci['seed'] }
+
+        if compare_classes:
+            report.write('\n')
+            report.write('CLASSES\n')
+            report.write('-------\n')
+            
+            if stats is not None:
+                stats.start('metrics')
+            class_scores = class_prf(class_pairs_g)
+            labels, class_confusion = class_confusion_matrix(class_pairs_g)
+            if stats is not None:
+                stats.stop()
+            
+            if len(class_scores) == 0:
+                report.write('-- No classes to compare\n')
+            
+            for c in class_scores:
+                scores = class_scores[c]
+                report.write('-- ' + c + '\n')
+                report.write('\ttp: ' + str(scores['tp']) + ', fp: ' + str(scores['fp']) + ', fn: ' + str(scores['fn']) + '\n')
+                report.write('\tprecision: ' + str(scores['precision']) + '\n')
+                report.write('\trecall   : ' + str(scores['recall']) + '\n')
+                report.write('\tf-score  : ' + str(scores['f-score']) + '\n')
+            
+            if len(labels) > 0:
+                report.write('-- Confusion of matched spans (rows: ' + ann1 + ', columns: ' + ann2 + ')\n')
+                report.write('\t' + '\t'.join(labels) + '\n')
+                for label, row in zip(labels, class_confusion):
+                    report.write(label + '\t' + '\t'.join(str(n) for n in row) + '\n')
+            
+            results['classes'] = class_scores
+            results['class_confusion'] = { 'labels': labels, 'matrix': class_confusion }
+
+        # Per-class results, equivalent to scikit-learn's
+        if compare_attributes:
+            results['attributes'] = {}
+            report.write('\n')
+            report.write('ATTRIBUTES\n')
+            report.write('----------\n')
+            
+            if len(attrs_g) == 0:
+                report.write('-- No attributes to compare\n')
+            
+            if stats is not None:
+                stats.start('metrics')
+            matrices = confusion_matrices(attr_counts_g, n_matched_g, attrs_g)
+            if stats is not None:
+                stats.stop()
+            
+            for attr in sorted(attrs_g):
+                report.write('-- ' + attr + '\n')
+                confusion = matrices[attr][1]
+            
+                if stats is not None:
+                    stats.start('metrics')
+                scores = {}
+                scores['macro'] = confusion_prf(confusion, 'macro')
+                scores['micro'] = confusion_prf(confusion, 'micro')
+                k = confusion_kappa(confusion)
+                if stats is not None:
+                    stats.stop()
+
+                for score in scores:
+                    report.write('\tprecision (' + score + '): ' + str(scores[score][0]) + '\n')
+                    report.write('\trecall    (' + score + '): ' + str(scores[score][1]) + '\n')
+                    report.write('\tf-score   (' + score + '): ' + str(scores[score][2]) + '\n')
+
+                report.write('\tkappa            : ' + str(k) + '\n')
+                
+                results['attributes'][attr] = { 'macro': scores['macro'], 'micro': scores['micro'], 'kappa': k }
+                if ci is not None:
+                    report.write('\tkappa (' + level + ' CI)   : ' + str(list(ci['attributes'][attr]['kappa'])) + '\n')
+                    results['attributes'][attr]['kappa_ci'] = ci['attributes'][attr]['kappa']
 
-            for score in scores:
-                report_string += '\tprecision (' + score + '): ' + str(scores[score][0]) + '\n'
-                report_string += '\trecall    (' + score + '): ' + str(scores[score][1]) + '\n'
-                report_string += '\tf-score   (' + score + '): ' + str(scores[score][2]) + '\n'
+        #report_string = attr_prf(attr_agr_g, report_string)
 
-            k = cohen_kappa_score(sample1, sample2)
-            report_string += '\tkappa            : ' + str(k) + '\n'
+    if cache is not None:
+        print(cache.report(), file=sys.stderr)
 
-    #report_string = attr_prf(attr_agr_g, report_string)
+    if results_store is not None:
+        print(results_store.report(), file=sys.stderr)
 
-    print(report_string)
+    if stats is not None:
+        print(stats.report(), file=sys.stderr)
 
     if report_dir is not None:
         print('-- Printed report to file:', pout, file=sys.stderr)
-        fout.write(report_string)
-        fout.close()
\ No newline at end of file
+
+    return results
+
+
+def align_spans(tag_lists, matching):
+    """
+    Align the mentions of several annotators on the same document.
+    Mentions are grouped into items when they have the same offsets (strict
+    matching) or form a chain of overlapping spans (relaxed matching).
+    Return a list of items, each a list holding the first mention of every
+    annotator in the item, or None if the annotator has none.
+    """
+    spans = []
+    for r, tags in enumerate(tag_lists):
+        for tag in tags:
+            spans.append((int(tag['start']), int(tag['end']), r, tag))
+    spans.sort(key=lambda span: (span[0], span[1], span[2]))
+    
+    groups = []
+    group_key = None
+    for start, end, r, tag in spans:
+        if matching == 'strict':
+            new_group = (start, end) != group_key
+            group_key = (start, end)
+        else:
+            new_group = group_key is None or start > group_key
+            group_key = end if new_group else max(group_key, end)
+        if new_group:
+            groups.append([None] * len(tag_lists))
+        if groups[-1][r] is None:
+            groups[-1][r] = tag
+    
+    return groups
+
+
+def fleiss_kappa(ratings):
+    """
+    Fleiss' kappa for a list of items, each a list of the categories
+    assigned by every rater (the same number of raters for each item).
+    Return nan if there are no items or chance agreement is perfect.
+    """
+    import numpy as np
+    
+    if len(ratings) == 0:
+        return float('nan')
+    
+    codes = {}
+    coded = np.array([[codes.setdefault(c, len(codes)) for c in item] for item in ratings], dtype=np.int64)
+    n_items, n_raters = coded.shape
+    if n_raters < 2:
+        return float('nan')
+    
+    # Number of raters assigning each category to each item
+    counts = np.zeros((n_items, len(codes)), dtype=np.float64)
+    np.add.at(counts, (np.repeat(np.arange(n_items), n_raters), coded.ravel()), 1)
+    
+    p_items = (np.sum(counts * counts, axis=1) - n_raters) / (n_raters * (n_raters - 1))
+    p_bar = np.mean(p_items)
+    p_cats = np.sum(counts, axis=0) / (n_items * n_raters)
+    p_e = np.sum(p_cats * p_cats)
+    
+    if p_e == 1:
+        return float('nan')
+    
+    return float((p_bar - p_e) / (1 - p_e))
+
+
+def load_worker_document(pin):
+    """
+    Parse an annotation file in a worker process, with the cache shared by
+    init_worker_cache().
+    """
+    return load_mentions_with_attributes(pin, cache=worker_cache())
+
+
+def init_multi_worker(docs, attrs):
+    """
+    Share the document store and attributes of a multi-annotator run with a
+    worker process.
+    """
+    global MULTI_ATTRS
+    global MULTI_DOCS
+    MULTI_ATTRS = attrs
+    MULTI_DOCS = docs
+
+
+def score_corpus_pair(args):
+    """
+    Score a pair of annotators in a worker process, from the document store
+    and attributes set by init_multi_worker().
+    """
+    pairs, matching, ignore = args
+    
+    return score_annotator_pair(pairs, matching, MULTI_DOCS, MULTI_ATTRS, ignore)
+
+
+def score_annotator_pair(pairs, matching, docs, attrs, ignore=()):
+    """
+    Score all paired files of two annotators from a document store. Return
+    the global tp, fp and fn, and Cohen's kappa for each attribute.
+    """
+    tp_g = fp_g = fn_g = 0.0
+    attr_vals1_g = []
+    attr_vals2_g = []
+    for f1, f2 in pairs:
+        tp, fp, fn, _, attr_vals1, attr_vals2, _ = count_agreements(f1, f2, '', matching, docs, details=False, attrs=attrs, ignore=ignore)
+        tp_g += tp
+        fp_g += fp
+        fn_g += fn
+        attr_vals1_g.extend(attr_vals1)
+        attr_vals2_g.extend(attr_vals2)
+    
+    matrices = attribute_confusion_matrices(attr_vals1_g, attr_vals2_g, attrs)
+    kappas = {}
+    for attr in matrices:
+        kappas[attr] = confusion_kappa(matrices[attr][1])
+    
+    return tp_g, fp_g, fn_g, kappas
+
+
+def write_matrix_csv(pout, names, matrix):
+    """
+    Save an annotator x annotator matrix of scores to a CSV file.
+    """
+    with open(pout, 'w', newline='') as output:
+        writer = csv.writer(output)
+        writer.writerow([''] + names)
+        for name, row in zip(names, matrix):
+            writer.writerow([name] + row)
+
+
+def batch_multi_agreement(ann_dirs, report_dir=None, matching='relaxed', ignore_attributes=[], workers=1, cache=None):
+    """
+    Compute agreement between any number of annotators in a single run.
+    ann_dirs: list of tuples of the form ('Annotator_Name', 'Dir')
+    report_dir: output directory for the CSV matrices (none are written if None)
+    matching: specifies whether spans must be strict matches (strict) or partial matches (relaxed)
+    ignore_attributes: list of attributes to ignore
+    workers: number of processes used to load files and score pairs of annotators (on platforms that spawn processes, call from within an if __name__ == '__main__' block)
+    cache: optional AnnotationCache to reuse annotations parsed in earlier runs
+    Each corpus is listed and parsed once. Files are paired as in
+    batch_agreement(), and each ordered pair of annotators (a, b) is scored
+    with a as the reference, so that each cell is what batch_agreement()
+    gives for the pair. Matching is not symmetric (several mentions of the
+    reference can match the same mention of the other annotator), so (b, a)
+    is scored separately rather than derived from (a, b). Fleiss' kappa is computed over the spans aligned across all
+    annotators on files paired in every corpus, with the mention class (or
+    None for annotators without a mention) as category, and for each
+    attribute over the aligned spans annotated by everyone.
+    Return a dictionary of the matrices (lists of rows) and Fleiss' kappas.
+    """
+    if matching not in ['strict', 'relaxed']:
+        raise ValueError('-- Invalid matching type "' + str(matching) + '". Use "strict" or "relaxed".')
+    
+    if report_dir is not None and not os.path.isdir(report_dir):
+        raise ValueError('-- Invalid report directory "' + str(report_dir) + '".')
+    
+    names = [ann_dir[0] for ann_dir in ann_dirs]
+    dirs = [ann_dir[1] for ann_dir in ann_dirs]
+    n = len(ann_dirs)
+    
+    corpus_files = [[f for f in get_corpus_files(d) if f.endswith('xml')] for d in dirs]
+    
+    # Parse every file of every corpus once
+    all_files = [f for files in corpus_files for f in files]
+    docs = {}
+    if workers > 1:
+        with Pool(processes=workers, initializer=init_worker_cache, initargs=(cache,)) as pool:
+            chunksize = max(1, len(all_files) // (4 * workers))
+            for f, ann in zip(all_files, pool.imap(load_worker_document, all_files, chunksize)):
+                docs[f] = ann
+    else:
+        for f in all_files:
+            get_document(f, docs, cache)
+    
+    ignore = set(ignore_attributes)
+    attrs = get_all_annotated_attributes(all_files, [], docs, ignore=ignore)
+    
+    # Pair the files of each ordered pair of annotators
+    corpus_pairs = [(i, j) for i in range(n) for j in range(n) if i != j]
+    file_pairs = {}
+    for i, j in corpus_pairs:
+        file_pairs[(i, j)] = pair_files(corpus_files[i], dirs[i], corpus_files[j], dirs[j])[0]
+    
+    if workers > 1 and len(corpus_pairs) > 0:
+        with Pool(processes=workers, initializer=init_multi_worker, initargs=(docs, attrs)) as pool:
+            results = pool.map(score_corpus_pair, [(file_pairs[(i, j)], matching, ignore) for i, j in corpus_pairs])
+    else:
+        results = [score_annotator_pair(file_pairs[(i, j)], matching, docs, attrs, ignore) for i, j in corpus_pairs]
+    
+    precision = [[1.0 if i == j else None for j in range(n)] for i in range(n)]
+    recall = [[1.0 if i == j else None for j in range(n)] for i in range(n)]
+    fscore = [[1.0 if i == j else None for j in range(n)] for i in range(n)]
+    kappa = {}
+    for attr in attrs:
+        kappa[attr] = [[1.0 if i == j else None for j in range(n)] for i in range(n)]
+    
+    for (i, j), (tp, fp, fn, kappas) in zip(corpus_pairs, results):
+        precision[i][j], recall[i][j], fscore[i][j] = prf(tp, fp, fn)
+        for attr in kappas:
+            kappa[attr][i][j] = kappas[attr]
+    
+    # Align spans across all annotators on files paired in every corpus
+    span_ratings = []
+    attr_ratings = {}
+    for attr in attrs:
+        attr_ratings[attr] = []
+    
+    partners = [dict(file_pairs[(0, j)]) for j in range(1, n)]
+    for f0 in corpus_files[0]:
+        group = [f0] + [partner.get(f0, None) for partner in partners]
+        if None in group:
+            continue
+        tag_lists = [convert_file_annotations(docs[f]) for f in group]
+        for item in align_spans(tag_lists, matching):
+            span_ratings.append([tag['class'] if tag is not None else None for tag in item])
+            if None not in item:
+                for attr in attrs:
+                    attr_ratings[attr].append([tag.get(attr, None) for tag in item])
+    
+    fleiss = { 'spans': fleiss_kappa(span_ratings) }
+    for attr in sorted(attrs):
+        fleiss[attr] = fleiss_kappa(attr_ratings[attr])
+    
+    if report_dir is not None:
+        write_matrix_csv(os.path.join(report_dir, 'agreement_matrix_precision.csv'), names, precision)
+        write_matrix_csv(os.path.join(report_dir, 'agreement_matrix_recall.csv'), names, recall)
+        write_matrix_csv(os.path.join(report_dir, 'agreement_matrix_f-score.csv'), names, fscore)
+        for attr in sorted(attrs):
+            write_matrix_csv(os.path.join(report_dir, 'agreement_matrix_kappa_' + attr + '.csv'), names, kappa[attr])
+        pout = os.path.join(report_dir, 'agreement_fleiss_kappa.csv')
+        with open(pout, 'w', newline='') as output:
+            writer = csv.writer(output)
+            writer.writerow(['', 'fleiss_kappa', 'items'])
+            writer.writerow(['spans', fleiss['spans'], len(span_ratings)])
+            for attr in sorted(attrs):
+                writer.writerow([attr, fleiss[attr], len(attr_ratings[attr])])
+        print('-- Printed agreement matrices to directory:', report_dir, file=sys.stderr)
+    
+    if cache is not None:
+        print(cache.report(), file=sys.stderr)
+    
+    return { 'annotators': names,
+             'precision': precision,
+             'recall': recall,
+             'f-score': fscore,
+             'kappa': kappa,
+             'fleiss_kappa': fleiss
+             }
@@ -0,0 +1,306 @@
+# -*- coding: utf-8 -*-
+"""
+Persistent cache of parsed eHOST annotation files.
+
+Parsed data is stored per file in a SQLite database under a cache
+directory and is reused as long as the file size and modification time
+(and optionally a digest of its content) are unchanged. Agreement results
+of pairs of files are stored in the same way, keyed by both files.
+Both stores can be shared by threads: their database connection and
+counters are guarded by a lock.
+"""
+
+import hashlib
+import os
+import pickle
+import sqlite3
+import threading
+
+
+CACHE_FILE = 'ehost_annotation_cache_v1.sqlite'
+
+# cache shared with a worker process by init_worker_cache()
+WORKER_CACHE = None
+
+
+def init_worker_cache(cache):
+    """
+    Share a cache with a worker process, as the initializer of a Pool, so
+    that it is sent to each process once and each process opens a single
+    database connection, rather than one per task.
+    Forked processes receive the arguments of the initializer without
+    pickling, so the cache is copied through pickle here: the copy drops the
+    connection, lock and pending state of the parent, which must not be
+    used after a fork.
+    """
+    global WORKER_CACHE
+    if cache is not None:
+        cache = pickle.loads(pickle.dumps(cache))
+    WORKER_CACHE = cache
+
+
+def worker_cache():
+    """
+    Return the cache shared with the current worker process, or None.
+    """
+    return WORKER_CACHE
+
+
+class AnnotationCache(object):
+    """
+    Opt-in on-disk cache shared by the reader and agreement functions.
+    cache_dir: directory in which the cache database is stored
+    use_hash: also compare a SHA-1 digest of the file content, so that a file
+    rewritten with the same size and modification time is detected, and a
+    file that was only touched is not parsed again
+    """
+
+    def __init__(self, cache_dir, use_hash=False):
+        if not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir)
+        self.cache_dir = cache_dir
+        self.use_hash = use_hash
+        self.hits = 0
+        self.misses = 0
+        self._conn = None
+        self._stats = {}
+        self._lock = threading.Lock()
+
+    def __getstate__(self):
+        # Connections cannot be sent to worker processes, each one opens its own
+        state = self.__dict__.copy()
+        state['_conn'] = None
+        state['_stats'] = {}
+        state['_lock'] = None
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+
+    def _connect(self):
+        if self._conn is None:
+            self._conn = sqlite3.connect(os.path.join(self.cache_dir, CACHE_FILE), timeout=60, check_same_thread=False)
+            self._conn.execute('PRAGMA journal_mode=WAL')
+            self._conn.execute('CREATE TABLE IF NOT EXISTS entries ('
+                               'path TEXT, kind TEXT, size INTEGER, mtime INTEGER, digest TEXT, data BLOB, '
+                               'PRIMARY KEY (path, kind))')
+        return self._conn
+
+    def _digest(self, path):
+        if not self.use_hash:
+            return None
+        with open(path, 'rb') as f:
+            return hashlib.sha1(f.read()).hexdigest()
+
+    def get(self, pin, kind):
+        """
+        Return the cached data of the given kind for a file, or None if there
+        is none or the file has changed since it was stored.
+        """
+        path = os.path.abspath(pin)
+        st = os.stat(path)
+        with self._lock:
+            return self._get(path, kind, st)
+
+    def _get(self, path, kind, st):
+        conn = self._connect()
+        row = conn.execute('SELECT size, mtime, digest, data FROM entries WHERE path = ? AND kind = ?', (path, kind)).fetchone()
+
+        digest = None
+        if row is not None:
+            size, mtime, cached_digest, data = row
+            unchanged = size == st.st_size and mtime == st.st_mtime_ns
+            if self.use_hash:
+                digest = self._digest(path)
+                if digest == cached_digest:
+                    if not unchanged:
+                        conn.execute('UPDATE entries SET size = ?, mtime = ? WHERE path = ? AND kind = ?', (st.st_size, st.st_mtime_ns, path, kind))
+                        conn.commit()
+                    unchanged = True
+                else:
+                    unchanged = False
+            if unchanged:
+                self.hits += 1
+                return pickle.loads(data)
+
+        # Keep the state of the file before it is parsed, for put()
+        self._stats[(path, kind)] = (st.st_size, st.st_mtime_ns, digest)
+        self.misses += 1
+        return None
+
+    def contains(self, pin, kind):
+        """
+        Check whether data of the given kind is stored for a file whose size
+        and modification time are unchanged, without loading it or counting a
+        hit or miss. Digests are not compared, as that would read the file.
+        """
+        path = os.path.abspath(pin)
+        st = os.stat(path)
+        with self._lock:
+            row = self._connect().execute('SELECT size, mtime FROM entries WHERE path = ? AND kind = ?', (path, kind)).fetchone()
+        
+        return row is not None and row[0] == st.st_size and row[1] == st.st_mtime_ns
+
+    def put(self, pin, kind, data):
+        """
+        Store data of the given kind for a file.
+        """
+        path = os.path.abspath(pin)
+        with self._lock:
+            size, mtime, digest = self._stats.pop((path, kind), (None, None, None))
+        if size is None:
+            st = os.stat(path)
+            size, mtime = st.st_size, st.st_mtime_ns
+        if self.use_hash and digest is None:
+            digest = self._digest(path)
+        data = pickle.dumps(data, pickle.HIGHEST_PROTOCOL)
+
+        with self._lock:
+            conn = self._connect()
+            conn.execute('INSERT OR REPLACE INTO entries VALUES (?, ?, ?, ?, ?, ?)',
+                         (path, kind, size, mtime, digest, data))
+            conn.commit()
+
+    def add_stats(self, hits, misses):
+        """
+        Add hit and miss counts, e.g. from worker processes.
+        """
+        with self._lock:
+            self.hits += hits
+            self.misses += misses
+
+    def report(self):
+        """
+        Return a one-line summary of cache hits and misses.
+        """
+        return '-- Annotation cache: ' + str(self.hits) + ' hits, ' + str(self.misses) + ' misses'
+
+    def close(self):
+        with self._lock:
+            if self._conn is not None:
+                self._conn.close()
+                self._conn = None
+
+
+PAIR_RESULTS_FILE = 'ehost_pair_results_v2.sqlite'
+
+
+def file_fingerprint(path):
+    """
+    Fingerprint of a file from its size and modification time.
+    """
+    st = os.stat(path)
+    return str(st.st_size) + ':' + str(st.st_mtime_ns)
+
+
+class PairResultStore(object):
+    """
+    On-disk store of the agreement results of pairs of annotation files,
+    keyed by the paths and fingerprints of both files and by the scoring
+    parameters, so that a new run only has to score the pairs in which a
+    file was added or changed.
+    """
+
+    def __init__(self, cache_dir):
+        if not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir)
+        self.cache_dir = cache_dir
+        self.hits = 0
+        self.misses = 0
+        self._conn = None
+        self._lock = threading.Lock()
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_conn'] = None
+        state['_lock'] = None
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+
+    def _connect(self):
+        if self._conn is None:
+            self._conn = sqlite3.connect(os.path.join(self.cache_dir, PAIR_RESULTS_FILE), timeout=60, check_same_thread=False)
+            self._conn.execute('PRAGMA journal_mode=WAL')
+            self._conn.execute('CREATE TABLE IF NOT EXISTS pairs ('
+                               'path1 TEXT, path2 TEXT, params TEXT, fingerprint1 TEXT, fingerprint2 TEXT, data BLOB, '
+                               'PRIMARY KEY (path1, path2, params))')
+        return self._conn
+
+    def _lookup(self, pin1, pin2, params, column):
+        path1 = os.path.abspath(pin1)
+        path2 = os.path.abspath(pin2)
+        with self._lock:
+            row = self._connect().execute('SELECT fingerprint1, fingerprint2, ' + column + ' FROM pairs WHERE path1 = ? AND path2 = ? AND params = ?',
+                                          (path1, path2, params)).fetchone()
+        if row is not None and row[0] == file_fingerprint(path1) and row[1] == file_fingerprint(path2):
+            return row
+        return None
+
+    def contains(self, pin1, pin2, params):
+        """
+        Check whether a result is stored for a pair of files and scoring
+        parameters (a string) and neither file has changed since, without
+        loading it. Hits and misses are counted here.
+        """
+        found = self._lookup(pin1, pin2, params, '1') is not None
+        with self._lock:
+            if found:
+                self.hits += 1
+            else:
+                self.misses += 1
+        
+        return found
+
+    def get(self, pin1, pin2, params):
+        """
+        Return the stored result for a pair of files and scoring parameters,
+        or None if there is none or either file has changed.
+        """
+        row = self._lookup(pin1, pin2, params, 'data')
+        if row is None:
+            return None
+        
+        return pickle.loads(row[2])
+
+    def put(self, pin1, pin2, params, fingerprints, data):
+        """
+        Store the result for a pair of files, with the fingerprints the files
+        had before they were read.
+        """
+        data = pickle.dumps(data, pickle.HIGHEST_PROTOCOL)
+        with self._lock:
+            conn = self._connect()
+            conn.execute('INSERT OR REPLACE INTO pairs VALUES (?, ?, ?, ?, ?, ?)',
+                         (os.path.abspath(pin1), os.path.abspath(pin2), params, fingerprints[0], fingerprints[1], data))
+            conn.commit()
+
+    def prune(self, pairs, params):
+        """
+        Delete the results stored for the given parameters whose pair of
+        files is not in pairs, e.g. because one of the files has vanished.
+        """
+        keep = set((os.path.abspath(pin1), os.path.abspath(pin2)) for pin1, pin2 in pairs)
+        with self._lock:
+            conn = self._connect()
+            rows = conn.execute('SELECT path1, path2 FROM pairs WHERE params = ?', (params,)).fetchall()
+            stale = [(path1, path2, params) for path1, path2 in rows if (path1, path2) not in keep]
+            conn.executemany('DELETE FROM pairs WHERE path1 = ? AND path2 = ? AND params = ?', stale)
+            conn.commit()
+        
+        return len(stale)
+
+    def report(self):
+        """
+        Return a one-line summary of reused and rescored pairs.
+        """
+        return '-- Pair results: ' + str(self.hits) + ' reused, ' + str(self.misses) + ' rescored'
+
+    def close(self):
+        with self._lock:
+            if self._conn is not None:
+                self._conn.close()
+                self._conn = None
@@ -5,108 +5,345 @@ Created on Tue Aug  7 16:20:44 2018
 @author: ABittar
 """
 
+import csv
+import io
 import os
-import pandas as pd
 import re
 import sys
 import xml.etree.ElementTree as ET
 
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from ehost_annotation_cache import init_worker_cache, worker_cache
+from ehost_mention_store import MentionStore
+from multiprocessing import Pool
 from xml.etree.ElementTree import ParseError
 
 
-def get_corpus_files(main_dir, file_types='both'):
+CORPUS_SUBDIRS = { 'txt': ('corpus', '.txt'), 'xml': ('saved', '.xml') }
+
+
+def scan_files(d, suffix='', with_stats=False):
+    """
+    List the files in a directory whose names end with suffix, using the
+    file type information returned by os.scandir(). With with_stats, return
+    (path, size, mtime in ns) tuples instead of paths.
+    A missing directory gives an empty list.
+    """
+    files = []
+    try:
+        it = os.scandir(d)
+    except FileNotFoundError:
+        return files
+    
+    with it:
+        for entry in it:
+            if entry.name.endswith(suffix) and entry.is_file():
+                if with_stats:
+                    st = entry.stat()
+                    files.append((entry.path, st.st_size, st.st_mtime_ns))
+                else:
+                    files.append(entry.path)
+    
+    return files
+
+
+def scan_corpus(main_dir, file_types='both', suffix=None, with_stats=False, io_workers=1):
+    """
+    List the text files (corpus/*.txt) and/or annotation files
+    (saved/*.xml) of every patient directory under a base directory in a
+    single walk with os.scandir().
+    file_types: 'txt', 'xml' or 'both'
+    suffix: file name ending to select instead of the default extensions
+    with_stats: return (path, size, mtime in ns) tuples instead of paths
+    io_workers: number of threads listing patient directories concurrently, for file systems with a high latency per request such as network shares
+    """
+    subdirs = []
+    for file_type in ['txt', 'xml']:
+        if file_types in [file_type, 'both']:
+            subdir, ext = CORPUS_SUBDIRS[file_type]
+            subdirs.append((subdir, suffix or ext))
+    
+    with os.scandir(main_dir) as it:
+        patient_dirs = [entry.path for entry in it if entry.is_dir()]
+    
+    dirs = []
+    exts = []
+    for patient_dir in patient_dirs:
+        for subdir, ext in subdirs:
+            dirs.append(os.path.join(patient_dir, subdir))
+            exts.append(ext)
+    
+    if io_workers > 1 and len(dirs) > 1:
+        with ThreadPoolExecutor(max_workers=io_workers) as executor:
+            listings = list(executor.map(scan_files, dirs, exts, [with_stats] * len(dirs)))
+    else:
+        listings = map(scan_files, dirs, exts, [with_stats] * len(dirs))
+    
+    corpus_list = []
+    for listing in listings:
+        corpus_list += listing
+    
+    return corpus_list
+
+
+def save_manifest(entries, pout):
+    """
+    Save (path, size, mtime) entries from scan_corpus() to a TSV manifest.
+    """
+    with open(pout, 'w', newline='', encoding='utf-8') as output:
+        writer = csv.writer(output, delimiter='\t', lineterminator='\n')
+        for entry in entries:
+            writer.writerow(entry)
+
+
+def load_manifest(pin):
+    """
+    Load a manifest written by save_manifest() as a dictionary of paths to
+    (size, mtime) tuples.
+    """
+    manifest = {}
+    with open(pin, 'r', newline='', encoding='utf-8') as f:
+        for path, size, mtime in csv.reader(f, delimiter='\t'):
+            manifest[path] = (int(size), int(mtime))
+    
+    return manifest
+
+
+def get_changed_corpus_files(main_dir, pin_manifest, file_types='both', update=True):
+    """
+    Compare the files under a base directory with a manifest from an earlier
+    run. Return the list of new or changed files and the list of files that
+    were removed. The manifest is created or updated unless update is False.
+    """
+    entries = scan_corpus(main_dir, file_types, with_stats=True)
+    
+    old_manifest = {}
+    if os.path.isfile(pin_manifest):
+        old_manifest = load_manifest(pin_manifest)
+    
+    changed = [path for path, size, mtime in entries if old_manifest.get(path, None) != (size, mtime)]
+    current = set(path for path, _, _ in entries)
+    removed = [path for path in old_manifest if path not in current]
+    
+    if update:
+        save_manifest(entries, pin_manifest)
+    
+    return changed, removed
+
+
+def get_corpus_files(main_dir, file_types='both', manifest=None, stats=None, io_workers=1):
     """
     Get a list of all annotation files with the specified extensions
     stored under a base directory.
+    manifest: optional path of a manifest file to save the paths, sizes and
+    modification times of the files to
+    stats: optional PipelineStats to add the discovery time and number of files listed to
+    io_workers: number of threads listing directories (see scan_corpus())
     """
+    if stats is not None:
+        with stats.stage('discovery'):
+            files = get_corpus_files(main_dir, file_types, manifest, io_workers=io_workers)
+        stats.count('files_listed', len(files))
+        return files
+    
     print('-- Listing files of type "' + file_types + '" in ' + main_dir)
-    corpus_dirs = [os.path.join(main_dir, d) for d in os.listdir(main_dir) if os.path.isdir(os.path.join(main_dir, d))]
     
-    corpus_list = []
+    if manifest is not None:
+        entries = scan_corpus(main_dir, file_types, with_stats=True, io_workers=io_workers)
+        save_manifest(entries, manifest)
+        return [path for path, _, _ in entries]
+    
+    return scan_corpus(main_dir, file_types, io_workers=io_workers)
 
-    files = []
-    for d in corpus_dirs:
-        # TODO filter out non-directories (e.g when running on 'T:\\Andre Bittar\\ASD\\ASD_Tom\\')
-        if file_types in ['txt', 'both']:
-            files = [os.path.join(d, 'corpus', t) for t in os.listdir(os.path.join(d, 'corpus')) if os.path.splitext(t)[1] == '.txt' and os.path.isdir(os.path.join(d, 'corpus'))]
-        if file_types in ['xml', 'both']:
-            files += [os.path.join(d, 'saved', t) for t in os.listdir(os.path.join(d, 'saved')) if os.path.splitext(t)[1] == '.xml' and os.path.isdir(os.path.join(d, 'saved'))]
-        corpus_list += files
+
+def read_file(pin):
+    """
+    Return the content of a file as bytes.
+    """
+    with open(pin, 'rb') as f:
+        return f.read()
+
+
+class FilePrefetcher(object):
+    """
+    Read files ahead of their use in a bounded pool of threads, so that the
+    latency of each read (e.g. on a network share) overlaps with other reads
+    and with the processing of earlier files.
+    paths: files in the order in which they will be requested
+    io_workers: number of reading threads
+    max_in_flight: maximum number of files being read or held ahead of those requested, which bounds the memory used
+    read: function returning the content of a file (read_file() by default)
+    cache: optional AnnotationCache; files with up-to-date data of the given kind in it are not read, and get() returns None for them
+    kind: kind of the cached data, e.g. 'mentions' for load_mentions_with_attributes()
+    """
+
+    def __init__(self, paths, io_workers=8, max_in_flight=32, read=read_file, cache=None, kind='mentions'):
+        self.paths = list(paths)
+        self.read = read
+        self.cache = cache
+        self.kind = kind
+        self.max_in_flight = max(1, max_in_flight)
+        self._executor = ThreadPoolExecutor(max_workers=max(1, io_workers))
+        self._futures = {}
+        self._next = 0
+        self._fill()
+
+    def _fill(self):
+        while self._next < len(self.paths) and len(self._futures) < self.max_in_flight:
+            path = self.paths[self._next]
+            self._next += 1
+            if path not in self._futures:
+                self._futures[path] = self._executor.submit(self._read, path)
+
+    def _read(self, path):
+        # Checked in the reading thread, as it also waits on the file system
+        if self.cache is not None and self.cache.contains(path, self.kind):
+            return None
+        return self.read(path)
+
+    def get(self, path):
+        """
+        Return the content of a file, waiting for it to be read if needed,
+        or None if it is in the cache.
+        Files that were not listed, or requested again, are read directly.
+        """
+        future = self._futures.pop(path, None)
+        if future is None:
+            data = self.read(path)
+        else:
+            data = future.result()
+        self._fill()
         
-    for file in corpus_list:
-        assert os.path.isfile(file)
+        return data
 
-    return corpus_list
+    def close(self):
+        for future in self._futures.values():
+            future.cancel()
+        self._futures = {}
+        self._executor.shutdown(wait=True)
+
+    def __enter__(self):
+        return self
 
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+        return False
 
-def load_mentions_with_attributes(pin, full_key=True):
+
+def load_mentions_with_attributes(pin, full_key=True, cache=None, stats=None, data=None):
     """
     Create a mapping of all mentions to all their associated attributes.
     This is necessary due to the structure of eHOST XML documents in which
     these entities are stored in separate XML tags.
+    The document is streamed with iterparse and each annotation, slot and
+    class mention node is consumed and cleared in a single pass, so memory
+    does not grow with the size of the XML tree.
+    cache: optional AnnotationCache to reuse mentions parsed in earlier runs
+    stats: optional PipelineStats to add the parsing time and numbers of files, bytes and mentions to
+    data: optional content of the file (e.g. from a FilePrefetcher), parsed instead of reading it
     """
+    if full_key:
+        key = pin
+    else:
+        key = os.path.basename(pin)
+    
+    if stats is not None:
+        stats.start('parsing')
     
-    xml = ET.parse(pin)
-    annotation_nodes = xml.findall('annotation')
-    attribute_nodes = xml.findall('.//stringSlotMention')
-    mention_nodes = xml.findall('.//classMention')
+    mentions = None
+    if cache is not None:
+        mentions = cache.get(pin, 'mentions')
+    from_cache = mentions is not None
+    if not from_cache:
+        mentions = parse_mentions(pin, data)
+        if cache is not None:
+            cache.put(pin, 'mentions', mentions)
+    
+    if stats is not None:
+        stats.stop()
+        if from_cache:
+            stats.count('files_from_cache')
+        else:
+            stats.count('files_parsed')
+            stats.count('bytes_parsed', len(data) if data is not None else os.path.getsize(pin))
+        stats.count('mentions_loaded', len(mentions))
+    
+    return { key: mentions }
 
-    # Collect annotations and related data to insert into mentions
+
+def parse_mentions(pin, data=None):
+    """
+    Parse the mentions of an annotation file for
+    load_mentions_with_attributes(), from data (its content) if given.
+    Return a dictionary of mention ids to mentions.
+    """
     annotations = {}
-    for annotation_node in annotation_nodes:
-        annotation_id = annotation_node.find('mention').attrib['id']
-        annotator = annotation_node.find('annotator').text
-        start = annotation_node.find('span').attrib['start']
-        end = annotation_node.find('span').attrib['end']
+    attributes = {}
+    class_mentions = []
+    
+    source = pin
+    if data is not None:
+        source = io.BytesIO(data)
+    
+    context = ET.iterparse(source, events=('start', 'end'))
+    _, root = next(context)
+    
+    for event, node in context:
+        if event != 'end':
+            continue
         
-        comment_node = annotation_node.find('annotationComment')
-        comment = None
-        if comment_node is not None:
-            comment = comment_node.text
+        tag = node.tag
+        if tag == 'annotation':
+            # Collect annotations and related data to insert into mentions
+            annotation_id = node.find('mention').attrib['id']
+            annotator = node.find('annotator').text
+            span = node.find('span').attrib
+            
+            comment_node = node.find('annotationComment')
+            comment = None
+            if comment_node is not None:
+                comment = comment_node.text
+            
+            annotations[annotation_id] = (annotator, span['start'], span['end'], comment)
+        elif tag == 'stringSlotMention':
+            # Collect attributes and values to insert into mentions
+            attributes[node.attrib['id']] = (node[0].attrib['id'], node[1].attrib['value'])
+        elif tag == 'classMention':
+            # Keep mention classes and slot ids until all attributes are known
+            mention_class_node = node.find('.//mentionClass')
+            mention_class = None
+            if mention_class_node is not None:
+                mention_class = (mention_class_node.attrib['id'], mention_class_node.text)
+            slot_ids = [slot_node.attrib['id'] for slot_node in node.iterfind('.//hasSlotMention')]
+            class_mentions.append((node.attrib['id'], mention_class, slot_ids))
+        else:
+            continue
         
-        annotations[annotation_id] = (annotator, start, end, comment)
-    
-    # Collect attributes and values to insert into mentions
-    attributes = {}
-    for attribute_node in attribute_nodes:
-        attribute_id = attribute_node.attrib['id']
-        attribute_name = attribute_node[0].attrib['id']
-        attribute_value = attribute_node[1].attrib['value']
-        attributes[attribute_id] = (attribute_name, attribute_value)
+        # Discard the consumed subtree
+        root.clear()
     
-    # Collect mention classes so we can link them to the appropriate comment
+    # Link mention classes to the appropriate annotations and attributes
     mentions = {}
-    for mention_node in mention_nodes:
-        mention_id = mention_node.attrib['id']
-        mention_class_node = mention_node.findall('.//mentionClass')
-        if len(mention_class_node) > 0:
-            mention_class = mention_class_node[0].attrib['id']
-            mention_text = mention_class_node[0].text
+    for mention_id, mention_class, slot_ids in class_mentions:
+        if mention_class is not None:
             annotator, start, end, comment = annotations.get(mention_id, None)
-            mentions[mention_id] = { 'class': mention_class,
-                                     'text' : mention_text,
+            mentions[mention_id] = { 'class': mention_class[0],
+                                     'text' : mention_class[1],
                                      'annotator': annotator,
                                      'start': start,
                                      'end': end,
                                      'comment': comment
                                      }
 
-        # Retrieve ids of attribute nodes
-        slot_nodes = mention_node.findall('.//hasSlotMention')
-        for slot_node in slot_nodes:
-            temp = mentions.get(mention_id, None)
-            if temp is not None:
-                slot_id = slot_node.attrib['id']
+        # Insert attribute values
+        temp = mentions.get(mention_id, None)
+        if temp is not None:
+            for slot_id in slot_ids:
                 attr, val = attributes.get(slot_id)
                 temp[attr] = val
-                mentions[mention_id] = temp
-    
-    if full_key:
-        key = pin
-    else:
-        key = os.path.basename(pin)
     
-    return { key: mentions }
+    return mentions
 
 
 def convert_file_annotations(file_annotations):
@@ -123,13 +360,20 @@ def convert_file_annotations(file_annotations):
     return all_annotations
 
 
-def count_mentions(pin, attribs=False):
+def count_mentions(pin, attribs=False, cache=None):
     """
     Count all mention-level annotations in a document.
+    cache: optional AnnotationCache to reuse counts from earlier runs
     """
     mention_counts = {}
     xml = None
     
+    kind = 'attribute_counts' if attribs else 'mention_counts'
+    if cache is not None:
+        cached_counts = cache.get(pin, kind)
+        if cached_counts is not None:
+            return cached_counts
+    
     try:
         xml = ET.parse(pin)
     except ParseError as e:
@@ -150,134 +394,513 @@ def count_mentions(pin, attribs=False):
         n = mention_counts.get(mention_class, 0) + 1
         mention_counts[mention_class] = n
     
+    if cache is not None:
+        cache.put(pin, kind, mention_counts)
+    
     return mention_counts
 
 
-def batch_count_mentions(pin, attribs=False):
+def batch_count_mentions(pin, attribs=False, cache=None):
     """
     Count total mentions in a directory.
+    cache: optional AnnotationCache shared with the other reader functions
     """
-    files = os.listdir(pin)
+    files = scan_files(pin)
     
     global_counts = {}
     
-    for f in files:
-        fin = os.path.join(pin, f)
-        counts = count_mentions(fin, attribs=attribs)
+    for fin in files:
+        counts = count_mentions(fin, attribs=attribs, cache=cache)
         
         for key in counts:
-            tmp = global_counts.get(key, 0) + 1
+            tmp = global_counts.get(key, 0) + counts[key]
             global_counts[key] = tmp
     
+    if cache is not None:
+        print(cache.report(), file=sys.stderr)
+    
     return global_counts
 
 
-def batch_process_directory(pin, full_key=True):
+def stream_count_mentions(pin, cache=None):
+    """
+    Count the mention classes, attribute names and attribute name/value
+    pairs of a document while streaming over its tags, without keeping the
+    XML tree.
+    Return a dictionary with 'classes', 'attributes' and 'attribute_values'
+    Counters (the latter keyed by (attribute, value) tuples).
+    cache: optional AnnotationCache shared with the other reader functions
+    """
+    if cache is not None:
+        cached_counts = cache.get(pin, 'stream_counts')
+        if cached_counts is not None:
+            return cached_counts
+    
+    classes = Counter()
+    attributes = Counter()
+    attribute_values = Counter()
+    
+    try:
+        context = ET.iterparse(pin, events=('start', 'end'))
+        _, root = next(context)
+        for event, node in context:
+            if event != 'end':
+                continue
+            if node.tag == 'mentionClass':
+                classes[node.attrib['id']] += 1
+            elif node.tag == 'stringSlotMention':
+                attr = node[0].attrib['id']
+                attributes[attr] += 1
+                attribute_values[(attr, node[1].attrib['value'])] += 1
+                root.clear()
+            elif node.tag in ['annotation', 'classMention']:
+                root.clear()
+    except ParseError as e:
+        print('-- Error: unable to parse document ' + pin, file=sys.stderr)
+        print(e, file=sys.stderr)
+        return { 'classes': Counter(), 'attributes': Counter(), 'attribute_values': Counter() }
+    
+    counts = { 'classes': classes, 'attributes': attributes, 'attribute_values': attribute_values }
+    
+    if cache is not None:
+        cache.put(pin, 'stream_counts', counts)
+    
+    return counts
+
+
+def count_file_mentions(args):
+    """
+    Worker for batch_stream_count_mentions(): count the mentions of a
+    (file, cache) pair and return the counts and the cache hits and misses.
+    A cache of None stands for the one shared with the worker process by
+    init_worker_cache(), if any.
+    """
+    pin, cache = args
+    if cache is None:
+        cache = worker_cache()
+    hits = misses = 0
+    if cache is not None:
+        hits, misses = cache.hits, cache.misses
+    
+    counts = stream_count_mentions(pin, cache=cache)
+    
+    if cache is not None:
+        hits, misses = cache.hits - hits, cache.misses - misses
+    
+    return counts, (hits, misses)
+
+
+def batch_stream_count_mentions(pin, corpus=False, workers=1, cache=None):
+    """
+    Count the mentions and attributes of all documents in a directory,
+    optionally across a process pool.
+    pin: a directory of annotation files, or a corpus base directory if corpus is True
+    workers: number of processes (on platforms that spawn processes, call from within an if __name__ == '__main__' block)
+    cache: optional AnnotationCache shared with the other reader functions
+    Return a dictionary of Counters:
+        'mentions': number of mentions per class
+        'documents': number of documents containing each class
+        'attributes': number of values per attribute
+        'attribute_documents': number of documents containing each attribute
+        'attribute_values': number of mentions per (attribute, value) pair
+    """
+    if corpus:
+        files = scan_corpus(pin, 'xml')
+    else:
+        files = scan_files(pin, '.xml')
+    
+    totals = { 'mentions': Counter(),
+               'documents': Counter(),
+               'attributes': Counter(),
+               'attribute_documents': Counter(),
+               'attribute_values': Counter()
+               }
+    
+    pool = None
+    if workers > 1 and len(files) > 0:
+        # The cache is sent to each process once, not with every file
+        pool = Pool(processes=workers, initializer=init_worker_cache, initargs=(cache,))
+        results = pool.imap(count_file_mentions, [(f, None) for f in files], max(1, len(files) // (4 * workers)))
+    else:
+        results = map(count_file_mentions, [(f, cache) for f in files])
+    
+    try:
+        for counts, cache_stats in results:
+            totals['mentions'].update(counts['classes'])
+            totals['documents'].update(counts['classes'].keys())
+            totals['attributes'].update(counts['attributes'])
+            totals['attribute_documents'].update(counts['attributes'].keys())
+            totals['attribute_values'].update(counts['attribute_values'])
+            if pool is not None and cache is not None:
+                cache.add_stats(*cache_stats)
+    finally:
+        if pool is not None:
+            # Stops the workers still running if an error occurred
+            pool.terminate()
+            pool.join()
+    
+    if cache is not None:
+        print(cache.report(), file=sys.stderr)
+    
+    return totals
+
+
+def batch_process_directory(pin, full_key=True, cache=None, compact=False, stats=None, io_workers=0, max_in_flight=32):
     """
     Get all annotations from the corpus and store a mapping of file names to 
     annotations.
+    cache: optional AnnotationCache shared with the other reader functions
+    compact: return a MentionStore, which holds the mentions in compact
+    columns behind the same mapping interface, instead of nested dictionaries
+    stats: optional PipelineStats to add discovery and parsing times and counts to
+    io_workers: number of threads listing directories and reading files ahead of parsing (files are read when parsed if 0)
+    max_in_flight: maximum number of files read ahead (see FilePrefetcher)
     """
-    global_annotations = {}
+    if compact:
+        global_annotations = MentionStore()
+    else:
+        global_annotations = {}
     
-    d_list = [os.path.join(pin, os.path.join(d, 'saved')) for d in os.listdir(pin) if not '.' in d]
+    if stats is not None:
+        with stats.stage('discovery'):
+            f_list = scan_corpus(pin, 'xml', suffix='knowtator.xml', io_workers=io_workers)
+        stats.count('files_listed', len(f_list))
+    else:
+        f_list = scan_corpus(pin, 'xml', suffix='knowtator.xml', io_workers=io_workers)
     
-    for d in d_list:
-        f_list = [os.path.join(d,f) for f in os.listdir(d) if f.endswith('knowtator.xml')]
-        
+    prefetcher = None
+    if io_workers > 0:
+        prefetcher = FilePrefetcher(f_list, io_workers, max_in_flight, cache=cache)
+    
+    try:
         for f in f_list:
-            curr_annotations = load_mentions_with_attributes(f, full_key=full_key)
-            global_annotations.update(curr_annotations)
-            
+            data = None
+            if prefetcher is not None:
+                data = prefetcher.get(f)
+            curr_annotations = load_mentions_with_attributes(f, full_key=full_key, cache=cache, stats=stats, data=data)
+            if compact:
+                for key in curr_annotations:
+                    global_annotations.add_file(key, curr_annotations[key])
+            else:
+                global_annotations.update(curr_annotations)
+    finally:
+        if prefetcher is not None:
+            prefetcher.close()
+    
+    if cache is not None:
+        print(cache.report(), file=sys.stderr)
+    
+    if stats is not None:
+        print(stats.report(), file=sys.stderr)
+    
     return global_annotations
 
 
-def save_as_ehost_text(pin, pout_d):
+EXPORT_COLUMNS = ('file', 'patient', 'mention_id', 'class', 'start', 'end', 'text', 'annotator', 'comment')
+DICTIONARY_COLUMNS = ('file', 'patient', 'class', 'annotator')
+
+
+def mention_export_schema(attributes):
+    """
+    Return the pyarrow schema of the mentions exported by export_mentions().
+    File, patient, class, annotator and attribute columns are dictionary
+    encoded, offsets are 32-bit integers and other columns plain strings.
+    attributes: names of the attribute columns, which follow the base columns
+    """
+    import pyarrow as pa
+    
+    string_dict = pa.dictionary(pa.int32(), pa.string())
+    fields = []
+    for col in EXPORT_COLUMNS:
+        if col in DICTIONARY_COLUMNS:
+            fields.append(pa.field(col, string_dict))
+        elif col in ['start', 'end']:
+            fields.append(pa.field(col, pa.int32()))
+        else:
+            fields.append(pa.field(col, pa.string()))
+    for attr in attributes:
+        fields.append(pa.field(attr, string_dict))
+    
+    return pa.schema(fields)
+
+
+def build_record_batch(columns, dictionaries, schema):
+    """
+    Build a pyarrow RecordBatch from lists of column values. The values of
+    dictionary columns are codes into the dictionaries, given as mappings
+    of values to codes in code order.
+    """
+    import pyarrow as pa
+    
+    arrays = []
+    for field in schema:
+        values = columns[field.name]
+        if pa.types.is_dictionary(field.type):
+            arrays.append(pa.DictionaryArray.from_arrays(pa.array(values, type=pa.int32()),
+                                                         pa.array(list(dictionaries[field.name]), type=pa.string())))
+        else:
+            arrays.append(pa.array(values, type=field.type))
+    
+    return pa.RecordBatch.from_arrays(arrays, schema=schema)
+
+
+def mention_record_batches(pin, attributes, batch_size=65536, cache=None):
+    """
+    Stream the mentions of all annotation files of a corpus as pyarrow
+    RecordBatches of up to batch_size rows, one row per mention, with the
+    schema of mention_export_schema().
+    The dictionaries of encoded columns only grow from one batch to the
+    next, so that later batches can be written as dictionary deltas.
+    Attributes that are not in attributes are left out.
+    cache: optional AnnotationCache shared with the other reader functions
+    """
+    schema = mention_export_schema(attributes)
+    dictionaries = {}
+    for field in schema:
+        if field.name in DICTIONARY_COLUMNS or field.name in attributes:
+            dictionaries[field.name] = {}
+    
+    columns = { field.name: [] for field in schema }
+    n = 0
+    
+    for f in scan_corpus(pin, 'xml', suffix='knowtator.xml'):
+        patient = os.path.basename(os.path.dirname(os.path.dirname(f)))
+        mentions = load_mentions_with_attributes(f, cache=cache)[f]
+        for mention_id, mention in mentions.items():
+            row = { 'file': f,
+                    'patient': patient,
+                    'mention_id': mention_id,
+                    'start': int(mention['start']),
+                    'end': int(mention['end'])
+                    }
+            for col, values in columns.items():
+                val = row.get(col, None)
+                if val is None:
+                    val = mention.get(col, None)
+                d = dictionaries.get(col, None)
+                if d is not None and val is not None:
+                    code = d.get(val, None)
+                    if code is None:
+                        code = d[val] = len(d)
+                    val = code
+                values.append(val)
+            n += 1
+            
+            if n == batch_size:
+                yield build_record_batch(columns, dictionaries, schema)
+                columns = { field.name: [] for field in schema }
+                n = 0
+    
+    if n > 0:
+        yield build_record_batch(columns, dictionaries, schema)
+
+
+def export_mentions(pin, pout, attributes=None, batch_size=65536, workers=1, cache=None):
+    """
+    Export all mentions of a corpus, one row per mention, to a Parquet
+    (.parquet) or Arrow IPC (.arrow, .feather) file without building the
+    nested dictionaries of batch_process_directory(). Mentions are written
+    in batches of batch_size rows, each of which is a Parquet row group.
+    Requires pyarrow.
+    pin: corpus base directory
+    pout: output file
+    attributes: names of the attributes to export as columns (all attributes found in the corpus, in alphabetical order, if None)
+    workers: number of processes used to find the attributes of the corpus
+    cache: optional AnnotationCache shared with the other reader functions
+    Return the number of mentions exported.
+    """
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+    
+    if attributes is None:
+        attributes = sorted(batch_stream_count_mentions(pin, corpus=True, workers=workers, cache=cache)['attributes'])
+    
+    schema = mention_export_schema(attributes)
+    ext = os.path.splitext(pout)[1].lower()
+    if ext == '.parquet':
+        writer = pq.ParquetWriter(pout, schema)
+    elif ext in ['.arrow', '.feather']:
+        writer = pa.ipc.new_file(pout, schema, options=pa.ipc.IpcWriteOptions(emit_dictionary_deltas=True))
+    else:
+        raise ValueError('-- Unsupported export format: ' + pout + ' (use .parquet, .arrow or .feather)')
+    
+    n = 0
+    with writer:
+        for batch in mention_record_batches(pin, attributes, batch_size, cache):
+            if ext == '.parquet':
+                writer.write_batch(batch, row_group_size=batch_size)
+            else:
+                writer.write_batch(batch)
+            n += batch.num_rows
+    
+    print('-- Exported', n, 'mentions to file:', pout, file=sys.stderr)
+    
+    return n
+
+
+def read_note_chunks(pin, chunksize=None):
+    """
+    Read a DataFrame of notes from a pickle, Parquet (.parquet) or CSV (.csv)
+    file and yield it in chunks of chunksize rows (in one piece if None).
+    Parquet and CSV files are read incrementally, Parquet through pyarrow.
+    """
+    import pandas as pd
+    
+    ext = os.path.splitext(pin)[1].lower()
+    
+    if ext == '.parquet':
+        if chunksize is None:
+            yield pd.read_parquet(pin)
+        else:
+            import pyarrow.parquet as pq
+            for batch in pq.ParquetFile(pin).iter_batches(batch_size=chunksize):
+                yield batch.to_pandas()
+    elif ext == '.csv':
+        if chunksize is None:
+            yield pd.read_csv(pin)
+        else:
+            for chunk in pd.read_csv(pin, chunksize=chunksize):
+                yield chunk
+    else:
+        df = pd.read_pickle(pin)
+        if chunksize is None:
+            yield df
+        else:
+            for i in range(0, len(df), chunksize):
+                yield df.iloc[i:i + chunksize]
+
+
+def write_text(pout, text):
+    with open(pout, 'w', encoding='utf-8') as output:
+        output.write(text)
+
+
+def save_as_ehost_text(pin, pout_d, chunksize=None, workers=1, verbose=True):
     """
     Save texts from a Dataframe in eHOST directory structure.
     Directories are BRCIDs and file names are made up of the date and CN_Doc_ID of the documents.
     NB: make sure all column names are as required by the function.
+    pin: a pickle, Parquet (.parquet) or CSV (.csv) file
+    chunksize: number of rows to read at a time (read the whole file if None)
+    workers: number of threads writing the files
+    verbose: print the path of each file written
     """
-    gp = pd.read_pickle(pin).groupby('BrcId')
+    import pandas as pd
+    
+    # The config/corpus/saved tree of each patient is created once, and file
+    # numbers are kept per (BRCID, date, CN_Doc_ID) instead of probing for
+    # existing files
+    created = set()
+    suffixes = {}
+    file_pattern = re.compile('^(.+)_([0-9]+)\\.txt$')
     
-    for g in gp:
-        for i, row in g[1].iterrows():
-            brcid = str(row.BrcId)
-            cndocid = str(row.CN_Doc_ID)
-            text = row.text
+    executor = None
+    if workers > 1:
+        executor = ThreadPoolExecutor(max_workers=workers)
+    
+    for chunk in read_note_chunks(pin, chunksize):
+        brcids = [str(brcid) for brcid in chunk['BrcId'].tolist()]
+        cndocids = [str(cndocid) for cndocid in chunk['CN_Doc_ID'].tolist()]
+        dates = pd.to_datetime(chunk['ViewDate']).dt.strftime('%Y-%m-%d').tolist()
+        texts = chunk['text'].tolist()
+        
+        pouts = []
+        outputs = []
+        for brcid, cndocid, date, text in zip(brcids, cndocids, dates, texts):
             # skip empty documents
-            if text is None:
+            if text is None or pd.isnull(text):
                 continue
-            date = str(row.ViewDate.strftime('%Y-%m-%d'))
             dout = os.path.join(pout_d, brcid)
             corpus_dir = os.path.join(dout, 'corpus')
             
-            if not os.path.isdir(dout):
-                os.mkdir(dout)
-                os.mkdir(os.path.join(dout, 'config'))
-                os.mkdir(corpus_dir)
-                os.mkdir(os.path.join(dout, 'saved'))
-            
-            fout = date + '_' + cndocid + '_00001.txt'
-            pout = os.path.join(corpus_dir, fout)
+            if brcid not in created:
+                os.makedirs(os.path.join(dout, 'config'), exist_ok=True)
+                os.makedirs(corpus_dir, exist_ok=True)
+                os.makedirs(os.path.join(dout, 'saved'), exist_ok=True)
+                # Number new files after those written by earlier runs
+                for f in os.listdir(corpus_dir):
+                    match = file_pattern.match(f)
+                    if match is not None:
+                        key = (brcid, match.group(1))
+                        suffixes[key] = max(suffixes.get(key, 0), int(match.group(2)))
+                created.add(brcid)
             
-            while os.path.isfile(pout):
-                match = re.search('_([0-9]+).txt', pout)
-                if match is not None:
-                    fout = date + '_' + cndocid + '_' + str(int(match.group(1)) + 1).zfill(5) + '.txt'
-                    pout = os.path.join(corpus_dir, fout)
+            key = (brcid, date + '_' + cndocid)
+            n = suffixes.get(key, 0) + 1
+            suffixes[key] = n
             
-            print('-- Writing file:', pout)
-            with open(pout, 'w', encoding='utf-8') as output:
-                output.write(text)
-            output.close()
+            fout = date + '_' + cndocid + '_' + str(n).zfill(5) + '.txt'
+            pout = os.path.join(corpus_dir, fout)
             
+            if verbose:
+                print('-- Writing file:', pout)
+            pouts.append(pout)
+            outputs.append(text)
+        
+        if executor is not None:
+            # Consume the results to wait for the chunk and raise write errors
+            list(executor.map(write_text, pouts, outputs))
+        else:
+            for pout, text in zip(pouts, outputs):
+                write_text(pout, text)
+    
+    if executor is not None:
+        executor.shutdown()
+    
     print('Done.')
 
 
-def ehost2tsv(pin, pout_d, annotation_types, verbose=False):
+def load_spacy_model(model='en_core_web_sm'):
     """
-    Save an eHOST annotated file in tabulation-separated values (TSV) format.
-    pin: the input file path
-    pout_d: the output directory path
-    annotation_types: the list of all annotation types to output as columns
-    word\tann1\tann2\t...\tann_n
+    Load a spaCy model. Load the model once and pass it to ehost2tsv() or
+    batch_ehost2tsv() when converting several files.
     """
-
-    # Set up spaCy
     import spacy
-    from spacy.tokens import Token
-    nlp = spacy.load('en_core_web_sm')    
-    Token.set_extension('sentnum', default=False, force=True)
-
-    # Create output directory and file path
-    if not os.path.exists(pout_d):
-        os.makedirs(pout_d)
-    pout = os.path.join(pout_d, os.path.splitext(os.path.basename(pin))[0] + '.csv')
-    
-    # Avoid duplicates of obligatory default atttributes
-    annotation_types = sorted(set(annotation_types).difference(set(['text', 'start', 'end'])))
-    
-    # Get annotations
-    def annotations_by_start_offset(annotations):
-        """
-        Return annotations by start offset
-        """
-        ann_dict = {}
-        for ann in annotations:
-            start = int(ann['start'])
-            ann_dict[start] = ann
     
-        return ann_dict
+    return spacy.load(model)
 
-    annotations = convert_file_annotations(load_mentions_with_attributes(pin))
-    annotations = annotations_by_start_offset(annotations)
 
-    # Get eHOST text
+def annotations_by_start_offset(annotations):
+    """
+    Return annotations by start offset
+    """
+    ann_dict = {}
+    for ann in annotations:
+        start = int(ann['start'])
+        ann_dict[start] = ann
+
+    return ann_dict
+
+
+def get_ehost_text_path(pin):
+    """
+    Return the path of the corpus text of an eHOST annotation file.
+    """
     pin_text = pin.replace('saved', 'corpus').replace('.knowtator.xml', '')
     assert os.path.isfile(pin_text)
     
-    text = open(pin_text, 'r').read()
-    doc = nlp(text)
+    return pin_text
+
+
+TSV_COLUMNS = ['sentnum', 'start', 'end', 'word', 'lemma', 'pos', 'dep', 'head']
+
+
+def ehost_doc_rows(pin, doc, annotation_types, verbose=False):
+    """
+    Generate the output rows for the tokens of a spaCy document parsed from
+    the text of an eHOST annotated file, as (token index, values) tuples.
+    Values follow TSV_COLUMNS and then annotation_types, which must not
+    contain 'text', 'start' or 'end'.
+    Annotation spans are tokenized with the tokens of the document itself,
+    one row per token.
+    """
+    from spacy.tokens import Token
+    if not Token.has_extension('sentnum'):
+        Token.set_extension('sentnum', default=False)
+    
+    # Get annotations
+    annotations = convert_file_annotations(load_mentions_with_attributes(pin))
+    annotations = annotations_by_start_offset(annotations)
     
     # Store sentence numbers on tokens
     for i, sent in enumerate(doc.sents):
@@ -287,43 +910,40 @@ def ehost2tsv(pin, pout_d, annotation_types, verbose=False):
     flagged = []
     i = 0
     
-    df = pd.DataFrame(columns=['sentnum', 'start', 'end', 'word', 'lemma', 'pos', 'dep', 'head'] + annotation_types)
     while i < len(doc):
         token = doc[i]
         token_start = token.idx
         token_end = token.idx + len(token) - 1
             
-        output = []
         if token_start in annotations:
             ann = annotations[token_start]
             ann_text = ann.get('text')
-            ann_doc = nlp(ann_text)
+            # Tokens of the document covered by the annotation text
+            ann_end = token_start + len(ann_text or '')
+            j = i + 1
+            while j < len(doc) and doc[j].idx < ann_end:
+                j += 1
+            ann_doc = doc[i:j]
+            ann_values = [ann.get(ann_type, '-') for ann_type in annotation_types]
             for ann_tok in ann_doc:
-                ann_output = []
-                ann_tok_start = token_start + ann_tok.idx
+                ann_tok_start = ann_tok.idx
                 ann_tok_end = ann_tok_start + len(ann_tok) - 1
-                output_str = str(token._.sentnum) + '\t' + str(ann_tok_start) + '\t' + str(ann_tok_end) + '\t' + ann_tok.text + '\t' + ann_tok.lemma_ + '\t' + token.tag_ +  '\t' + ann_tok.dep_ + '\t' + str(ann_tok.head)
-                ann_output += [token._.sentnum, ann_tok_start, ann_tok_end, ann_tok.text, ann_tok.lemma_, token.tag_ , ann_tok.dep_, ann_tok.head]
+                ann_output = [token._.sentnum, ann_tok_start, ann_tok_end, ann_tok.text, ann_tok.lemma_, token.tag_ , ann_tok.dep_, str(ann_tok.head)] + ann_values
                 if verbose:
+                    output_str = '\t'.join(str(v) for v in ann_output[:len(TSV_COLUMNS)])
                     print(output_str, end='\t', file=sys.stdout)
-                for ann_type in annotation_types:
-                    if verbose:
-                        print(ann.get(ann_type, '-') + '\t', end='\t', file=sys.stdout)
-                    ann_output.append(ann.get(ann_type, '-'))
-                df.loc[i] = ann_output
-                if verbose:
+                    for val in ann_values:
+                        print(val + '\t', end='\t', file=sys.stdout)
                     print('\n', end='', file=sys.stdout)
+                yield ann_tok.i, ann_output
             flagged.append(token_start)
             i += len(ann_doc) - 1
         else:
-            output_str = str(token._.sentnum) + '\t' + str(token_start) + '\t' + str(token_end) + '\t' + token.text + '\t' + token.lemma_ + '\t' + token.tag_ + '\t' + token.dep_ + '\t' + str(token.head)
-            output_str += '\t-' * len(annotation_types)
-            output += [token._.sentnum, token_start, token_end, token.text, token.lemma_, token.tag_, token.dep_, token.head]
+            output = [token._.sentnum, token_start, token_end, token.text, token.lemma_, token.tag_, token.dep_, str(token.head)]
             output += ['-'] * len(annotation_types)
             if verbose:
-                print(output_str, end='', file=sys.stdout)
-            # Store the line in the DataFrame
-            df.loc[i] = output
+                print('\t'.join(str(v) for v in output), end='', file=sys.stdout)
+            yield i, output
         if verbose:
             print('', file=sys.stdout)
         i += 1
@@ -336,7 +956,99 @@ def ehost2tsv(pin, pout_d, annotation_types, verbose=False):
     if flagged != gold:
         print('-- Unequal number of annotations for', pin)
 
-    df.to_csv(pout)
+
+def ehost_doc2tsv(pin, doc, pout_d, annotation_types, verbose=False, return_df=True):
+    """
+    Save the tokens of a spaCy document parsed from the text of an eHOST
+    annotated file, along with the annotations of the file, in
+    tabulation-separated values (TSV) format.
+    Rows are streamed to the output file with the csv module. If return_df
+    is True, they are also collected in columns and returned as a DataFrame,
+    otherwise the path of the output file is returned.
+    """
+    # Create output directory and file path
+    if not os.path.exists(pout_d):
+        os.makedirs(pout_d)
+    pout = os.path.join(pout_d, os.path.splitext(os.path.basename(pin))[0] + '.csv')
+    
+    # Avoid duplicates of obligatory default atttributes
+    annotation_types = sorted(set(annotation_types).difference(set(['text', 'start', 'end'])))
+    columns = TSV_COLUMNS + annotation_types
+    
+    index = []
+    values = [[] for _ in columns]
+    
+    with open(pout, 'w', newline='', encoding='utf-8') as output:
+        writer = csv.writer(output, lineterminator=os.linesep)
+        writer.writerow([''] + columns)
+        for i, row in ehost_doc_rows(pin, doc, annotation_types, verbose=verbose):
+            writer.writerow([i] + row)
+            if return_df:
+                index.append(i)
+                for column, val in zip(values, row):
+                    column.append(val)
+    
     print('-- Wrote file:', pout)
     
-    return df
\ No newline at end of file
+    if return_df:
+        import pandas as pd
+        return pd.DataFrame(dict(zip(columns, values)), index=index, columns=columns)
+    
+    return pout
+
+
+def ehost2tsv(pin, pout_d, annotation_types, verbose=False, nlp=None, return_df=True):
+    """
+    Save an eHOST annotated file in tabulation-separated values (TSV) format.
+    pin: the input file path
+    pout_d: the output directory path
+    annotation_types: the list of all annotation types to output as columns
+    nlp: a spaCy model from load_spacy_model() (loaded on each call if None)
+    return_df: return the output as a DataFrame (None otherwise)
+    word\tann1\tann2\t...\tann_n
+    """
+
+    # Set up spaCy
+    if nlp is None:
+        nlp = load_spacy_model()
+
+    # Get eHOST text
+    pin_text = get_ehost_text_path(pin)
+    
+    with open(pin_text, 'r', encoding='utf-8') as f:
+        text = f.read()
+    doc = nlp(text)
+    
+    return ehost_doc2tsv(pin, doc, pout_d, annotation_types, verbose=verbose, return_df=return_df)
+
+
+def batch_ehost2tsv(pins, pout_d, annotation_types, verbose=False, nlp=None, batch_size=50, n_process=1):
+    """
+    Save several eHOST annotated files in tabulation-separated values (TSV)
+    format, loading the spaCy model once and streaming the texts through
+    nlp.pipe().
+    pins: the input file paths
+    pout_d: the output directory path
+    annotation_types: the list of all annotation types to output as columns
+    nlp: a spaCy model from load_spacy_model() (en_core_web_sm if None)
+    batch_size: number of texts buffered by spaCy
+    n_process: number of processes used by spaCy
+    Return the list of output file paths.
+    """
+    if nlp is None:
+        nlp = load_spacy_model()
+    
+    # Iterated twice, for the texts and to pair them with their documents
+    pins = list(pins)
+    
+    def read_texts():
+        for pin in pins:
+            with open(get_ehost_text_path(pin), 'r', encoding='utf-8') as f:
+                yield f.read()
+    
+    pouts = []
+    docs = nlp.pipe(read_texts(), batch_size=batch_size, n_process=n_process)
+    for pin, doc in zip(pins, docs):
+        pouts.append(ehost_doc2tsv(pin, doc, pout_d, annotation_types, verbose=verbose, return_df=False))
+    
+    return pouts
@@ -0,0 +1,516 @@
+# -*- coding: utf-8 -*-
+"""
+Benchmarks of the eHOST reader and agreement modules.
+
+Import times are measured in fresh interpreters, as in the short-lived
+worker processes that import these modules, and heavy dependencies that are
+only needed by some functions must not be loaded at import time.
+
+The pipeline benchmarks run on synthetic eHOST projects written by
+generate_corpus(). Each stage (discovery, parsing, span matching, metrics,
+TSV conversion) is timed in a fresh process, so that its peak resident
+set size is its own, and results are reported as JSON.
+
+The I/O benchmark reads and parses a corpus through a shim that adds a
+fixed latency to every file read, as on a network share, to compare serial
+loading with the thread-pooled prefetching of FilePrefetcher.
+
+Usage:
+    python ehost_benchmark.py imports
+    python ehost_benchmark.py generate OUT_DIR --docs 100 --mentions 20
+    python ehost_benchmark.py run --scales 10 100 1000 --out results.json
+    python ehost_benchmark.py io CORPUS_DIR --latency 0.005 --io-workers 0 4 16
+"""
+
+import argparse
+import json
+import multiprocessing
+import os
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import xml.etree.ElementTree as ET
+
+from functools import partial
+
+try:
+    import resource
+except ImportError:
+    # Not available on Windows, where peak memory is not reported
+    resource = None
+
+
+# Modules that may only be imported by the functions that need them
+HEAVY_MODULES = ['numpy', 'pandas', 'pyarrow', 'sklearn', 'spacy']
+
+# Import time limits in seconds
+IMPORT_LIMITS = { 'ehost_annotation_reader': 0.3,
+                  'ehost_agreement': 0.3,
+                  'ehost_corpus_text': 0.3
+                  }
+
+IMPORT_SCRIPT = '''
+import json, sys, time
+t = time.perf_counter()
+import {module}
+t = time.perf_counter() - t
+print(json.dumps({{ 'seconds': t, 'loaded': [m for m in {heavy} if m in sys.modules] }}))
+'''
+
+
+def import_time(module, repeat=5):
+    """
+    Time the import of a module in repeat fresh interpreters.
+    Return a dictionary with the best time in seconds and the heavy
+    modules loaded by the import.
+    """
+    script = IMPORT_SCRIPT.format(module=module, heavy=repr(HEAVY_MODULES))
+    cwd = os.path.dirname(os.path.abspath(__file__))
+
+    best = None
+    loaded = []
+    for _ in range(repeat):
+        output = subprocess.run([sys.executable, '-c', script], cwd=cwd, check=True,
+                                stdout=subprocess.PIPE, universal_newlines=True).stdout
+        result = json.loads(output)
+        if best is None or result['seconds'] < best:
+            best = result['seconds']
+        loaded = result['loaded']
+
+    return { 'module': module, 'seconds': best, 'loaded': loaded }
+
+
+def check_import_times(limits=IMPORT_LIMITS, repeat=5):
+    """
+    Time the import of each module in limits (a dictionary of module names
+    to limits in seconds).
+    Return the results and a list of failures, i.e. modules that are slower
+    than their limit or that load a heavy module.
+    """
+    results = []
+    failures = []
+    for module in sorted(limits):
+        result = import_time(module, repeat)
+        results.append(result)
+        if result['seconds'] > limits[module]:
+            failures.append('-- ' + module + ' imported in ' + '{:.3f}'.format(result['seconds']) +
+                            's (limit ' + str(limits[module]) + 's)')
+        if len(result['loaded']) > 0:
+            failures.append('-- ' + module + ' loads ' + ', '.join(result['loaded']) + ' at import time')
+
+    return results, failures
+
+
+CLASSES = ['Symptom', 'Drug', 'Diagnosis', 'Procedure', 'Finding', 'Test']
+WORDS = ['patient', 'reports', 'no', 'history', 'of', 'chest', 'pain', 'and', 'was', 'started', 'on',
+         'aspirin', 'denies', 'fever', 'mood', 'low', 'since', 'last', 'review', 'with', 'mild',
+         'anxiety', 'prescribed', 'sertraline', 'daily', 'plan', 'to', 'continue', 'blood', 'tests',
+         'normal', 'the', 'sleep', 'poor', 'appetite', 'good', 'discharged', 'home', 'follow', 'up']
+STAGES = ['discovery', 'parsing', 'matching', 'metrics', 'tsv']
+
+
+def generate_text(rnd, n_words):
+    """
+    Return a random note of n_words words and the (start, end) offsets of
+    each word.
+    """
+    words = []
+    offsets = []
+    pos = 0
+    for i in range(n_words):
+        word = rnd.choice(WORDS)
+        if i > 0 and i % 12 == 0:
+            word += '.'
+        words.append(word)
+        offsets.append((pos, pos + len(word)))
+        pos += len(word) + 1
+    
+    return ' '.join(words), offsets
+
+
+def write_annotation_file(pout, text_name, annotator, text, mentions):
+    """
+    Write mentions in the eHOST XML format. Mentions are (start, end, class,
+    attributes) tuples, attributes a list of (name, value) pairs.
+    """
+    root = ET.Element('annotations', textSource=text_name)
+    class_mentions = []
+    slot_mentions = []
+    n = 0
+    for start, end, mention_class, attributes in mentions:
+        mention_id = 'EHOST_Instance_' + str(n)
+        n += 1
+        annotation = ET.SubElement(root, 'annotation')
+        ET.SubElement(annotation, 'mention', id=mention_id)
+        ET.SubElement(annotation, 'annotator', id='eHOST_2010').text = annotator
+        ET.SubElement(annotation, 'span', start=str(start), end=str(end))
+        ET.SubElement(annotation, 'spannedText').text = text[start:end]
+        ET.SubElement(annotation, 'creationDate').text = 'Mon Jan 01 00:00:00 GMT 2018'
+        
+        class_mention = ET.Element('classMention', id=mention_id)
+        ET.SubElement(class_mention, 'mentionClass', id=mention_class).text = text[start:end]
+        for attr, val in attributes:
+            slot_id = 'EHOST_Instance_' + str(n)
+            n += 1
+            ET.SubElement(class_mention, 'hasSlotMention', id=slot_id)
+            slot_mention = ET.Element('stringSlotMention', id=slot_id)
+            ET.SubElement(slot_mention, 'mentionSlot', id=attr)
+            ET.SubElement(slot_mention, 'stringSlotMentionValue', value=val)
+            slot_mentions.append(slot_mention)
+        class_mentions.append(class_mention)
+    
+    root.extend(class_mentions)
+    root.extend(slot_mentions)
+    status = ET.SubElement(root, 'eHOST_Adjudication_Status', version='1.0')
+    ET.SubElement(status, 'Adjudication_Selected_Classes', SelectedClasses_Enabled='true')
+    
+    ET.ElementTree(root).write(pout, encoding='UTF-8', xml_declaration=True)
+
+
+def generate_corpus(pout_d, n_docs=100, mentions_per_doc=20, overlap=0.8, n_attributes=3, attribute_cardinality=3, docs_per_patient=10, annotators=('A', 'B'), seed=0):
+    """
+    Write a synthetic eHOST project for each annotator, with the
+    <patient>/config, corpus and saved directories of real projects and the
+    same notes in every project.
+    pout_d: output directory, in which a directory is created per annotator
+    n_docs: number of documents
+    mentions_per_doc: number of mentions of the first annotator per document
+    overlap: rate of the mentions of the first annotator that each other annotator also annotates, half of them with exactly the same span and half with an overlapping span; the others are replaced by spurious mentions
+    n_attributes: number of attributes of each mention
+    attribute_cardinality: number of values of each attribute
+    docs_per_patient: number of documents per patient directory
+    annotators: names of the annotators
+    seed: random seed, the same parameters and seed always give the same corpus
+    Return a list of (annotator, directory) tuples, as expected by batch_agreement() and batch_multi_agreement().
+    """
+    rnd = random.Random(seed)
+    attributes = ['attribute_' + str(i) for i in range(n_attributes)]
+    values = ['value_' + str(i) for i in range(attribute_cardinality)]
+    n_words = max(50, mentions_per_doc * 10)
+    
+    ann_dirs = []
+    for annotator in annotators:
+        ann_dirs.append((annotator, os.path.join(pout_d, annotator)))
+    
+    def random_mention(offsets):
+        first = rnd.randrange(len(offsets))
+        last = min(len(offsets) - 1, first + rnd.randrange(3))
+        return (offsets[first][0], offsets[last][1], rnd.choice(CLASSES),
+                [(attr, rnd.choice(values)) for attr in attributes])
+    
+    for n in range(n_docs):
+        patient = 'patient_' + str(n // docs_per_patient).zfill(5)
+        text_name = 'note_' + str(n).zfill(6) + '.txt'
+        text, offsets = generate_text(rnd, n_words)
+        reference = [random_mention(offsets) for _ in range(mentions_per_doc)]
+        
+        for k, (annotator, d) in enumerate(ann_dirs):
+            for subdir in ['config', 'corpus', 'saved']:
+                os.makedirs(os.path.join(d, patient, subdir), exist_ok=True)
+            with open(os.path.join(d, patient, 'corpus', text_name), 'w', encoding='utf-8') as output:
+                output.write(text)
+            
+            if k == 0:
+                mentions = reference
+            else:
+                mentions = []
+                for start, end, mention_class, attrs in reference:
+                    if rnd.random() >= overlap:
+                        mentions.append(random_mention(offsets))
+                        continue
+                    if rnd.random() < 0.5:
+                        # Overlapping span, shifted to the next word
+                        start = min(start + 1, end - 1)
+                        end = offsets[min(len(offsets) - 1, text.count(' ', 0, end) + 1)][1]
+                    # Attribute values and classes mostly agree
+                    attrs = [(attr, val if rnd.random() < 0.8 else rnd.choice(values)) for attr, val in attrs]
+                    if rnd.random() >= 0.9:
+                        mention_class = rnd.choice(CLASSES)
+                    mentions.append((start, end, mention_class, attrs))
+            
+            pout = os.path.join(d, patient, 'saved', text_name + '.knowtator.xml')
+            write_annotation_file(pout, text_name, annotator, text, mentions)
+    
+    return ann_dirs
+
+
+def peak_rss_mb():
+    """
+    Peak resident set size of the current process in MB (None if unknown).
+    """
+    if resource is None:
+        return None
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == 'darwin':
+        # Bytes on macOS, kB elsewhere
+        return rss / (1024.0 * 1024.0)
+    return rss / 1024.0
+
+
+def run_stage(stage, ann_dirs, model='en_core_web_sm'):
+    """
+    Run and time one stage of the pipeline on a synthetic corpus. Inputs of
+    the stage, e.g. the parsed documents for span matching, are prepared
+    before the timer starts.
+    Return a dictionary with the time in seconds, the number of documents
+    and mentions processed and the peak resident set size in MB.
+    """
+    import ehost_agreement as ea
+    import ehost_annotation_reader as ear
+    
+    (_, dir1), (_, dir2) = ann_dirs[:2]
+    files1 = ear.scan_corpus(dir1, 'xml')
+    files2 = ear.scan_corpus(dir2, 'xml')
+    pairs = ea.pair_files(files1, dir1, files2, dir2)[0]
+    result = { 'stage': stage }
+    
+    if stage == 'discovery':
+        t = time.perf_counter()
+        files = ear.scan_corpus(dir1) + ear.scan_corpus(dir2)
+        result['seconds'] = time.perf_counter() - t
+        result['docs'] = len(files)
+        result['mentions'] = None
+    elif stage == 'parsing':
+        t = time.perf_counter()
+        docs = {}
+        for f in files1 + files2:
+            docs.update(ear.load_mentions_with_attributes(f))
+        result['seconds'] = time.perf_counter() - t
+        result['docs'] = len(docs)
+        result['mentions'] = sum(len(docs[f]) for f in docs)
+    elif stage in ['matching', 'metrics']:
+        docs = {}
+        attrs = ea.get_all_annotated_attributes(files1, files2, docs)
+        t = time.perf_counter()
+        results = [ea.count_agreements(f1, f2, '', 'relaxed', docs, details=False, attrs=attrs) for f1, f2 in pairs]
+        if stage == 'metrics':
+            # Run once so that the lazy numpy import is not timed
+            ea.confusion_matrices({}, 0, attrs)
+            t = time.perf_counter()
+            counts = {}
+            n_matched = 0
+            for tp, fp, fn, _, attr_vals1, attr_vals2, _ in results:
+                ea.attribute_value_counts(attr_vals1, attr_vals2, counts)
+                n_matched += len(attr_vals1)
+            matrices = ea.confusion_matrices(counts, n_matched, attrs)
+            for attr in matrices:
+                ea.confusion_prf(matrices[attr][1], 'macro')
+                ea.confusion_prf(matrices[attr][1], 'micro')
+                ea.confusion_kappa(matrices[attr][1])
+        result['seconds'] = time.perf_counter() - t
+        result['docs'] = 2 * len(pairs)
+        result['mentions'] = sum(len(docs[f1][f1]) + len(docs[f2][f2]) for f1, f2 in pairs)
+    elif stage == 'tsv':
+        try:
+            if model == 'blank':
+                import spacy
+                nlp = spacy.blank('en')
+                nlp.add_pipe('sentencizer')
+            else:
+                nlp = ear.load_spacy_model(model)
+        except (ImportError, OSError) as e:
+            result['skipped'] = str(e)
+            return result
+        attrs = sorted(ea.get_all_annotated_attributes(files1, []))
+        pout_d = tempfile.mkdtemp()
+        try:
+            with open(os.devnull, 'w') as devnull:
+                stdout = sys.stdout
+                sys.stdout = devnull
+                try:
+                    t = time.perf_counter()
+                    ear.batch_ehost2tsv(files1, pout_d, ['class'] + attrs, nlp=nlp)
+                    result['seconds'] = time.perf_counter() - t
+                finally:
+                    sys.stdout = stdout
+        finally:
+            shutil.rmtree(pout_d)
+        result['docs'] = len(files1)
+        result['mentions'] = sum(len(m) for f in files1 for m in ear.load_mentions_with_attributes(f).values())
+    else:
+        raise ValueError('-- Invalid stage "' + str(stage) + '". Use one of ' + ', '.join(STAGES) + '.')
+    
+    result['docs_per_s'] = result['docs'] / result['seconds'] if result['seconds'] > 0 else None
+    result['mentions_per_s'] = None
+    if result['mentions'] is not None and result['seconds'] > 0:
+        result['mentions_per_s'] = result['mentions'] / result['seconds']
+    result['peak_rss_mb'] = peak_rss_mb()
+    
+    return result
+
+
+def run_benchmarks(scales=(10, 100, 1000), mentions_per_doc=20, overlap=0.8, n_attributes=3, attribute_cardinality=3, stages=STAGES, model='en_core_web_sm', work_dir=None, seed=0):
+    """
+    Generate a synthetic corpus of two annotators for each number of
+    documents in scales and run each stage on it in a fresh process.
+    model: spaCy model for the TSV stage ('blank' for a blank English pipeline with a sentencizer), which is skipped if the model cannot be loaded
+    work_dir: directory for the corpora (a temporary directory, removed afterwards, if None)
+    Return a list of results (see run_stage()), with the parameters of each corpus.
+    """
+    tmp_dir = None
+    if work_dir is None:
+        work_dir = tmp_dir = tempfile.mkdtemp()
+    
+    # Spawned processes start from a fresh interpreter, so that the peak
+    # memory of a stage does not include that of earlier ones
+    ctx = multiprocessing.get_context('spawn')
+    results = []
+    try:
+        for n_docs in scales:
+            pout_d = os.path.join(work_dir, 'corpus_' + str(n_docs))
+            ann_dirs = generate_corpus(pout_d, n_docs, mentions_per_doc, overlap, n_attributes, attribute_cardinality, seed=seed)
+            for stage in stages:
+                pool = ctx.Pool(processes=1)
+                try:
+                    result = pool.apply(run_stage, (stage, ann_dirs, model))
+                finally:
+                    pool.close()
+                    pool.join()
+                result.update({ 'n_docs': n_docs,
+                                'mentions_per_doc': mentions_per_doc,
+                                'overlap': overlap,
+                                'n_attributes': n_attributes,
+                                'attribute_cardinality': attribute_cardinality
+                                })
+                results.append(result)
+                print('-- ' + str(n_docs) + ' documents, ' + stage + ': ' +
+                      ('skipped' if 'skipped' in result else '{:.3f}s'.format(result['seconds'])), file=sys.stderr)
+    finally:
+        if tmp_dir is not None:
+            shutil.rmtree(tmp_dir)
+    
+    return results
+
+
+def delayed_read(pin, latency=0.005):
+    """
+    Artificial-latency file system shim: return the content of a file as
+    bytes after waiting latency seconds. Use partial(delayed_read,
+    latency=...) as the read function of a FilePrefetcher.
+    """
+    time.sleep(latency)
+    with open(pin, 'rb') as f:
+        return f.read()
+
+
+def run_io_benchmark(ann_dir, latency=0.005, io_workers=(0, 1, 4, 16), max_in_flight=32):
+    """
+    Time the listing, reading and parsing of the annotation files of a
+    corpus with an artificial latency per read (see delayed_read()), once
+    for each number of I/O threads (0 to read each file when it is parsed).
+    Return a list of dictionaries with the parameters, time in seconds, number of
+    documents and whether the parsed mentions are identical to those of the
+    first run.
+    """
+    import ehost_annotation_reader as ear
+    
+    read = partial(delayed_read, latency=latency)
+    results = []
+    reference = None
+    for n in io_workers:
+        t = time.perf_counter()
+        files = ear.scan_corpus(ann_dir, 'xml', io_workers=max(1, n))
+        prefetcher = None
+        if n > 0:
+            prefetcher = ear.FilePrefetcher(files, n, max_in_flight, read=read)
+        docs = {}
+        for f in files:
+            data = read(f) if prefetcher is None else prefetcher.get(f)
+            docs.update(ear.load_mentions_with_attributes(f, data=data))
+        if prefetcher is not None:
+            prefetcher.close()
+        seconds = time.perf_counter() - t
+        
+        if reference is None:
+            reference = docs
+        results.append({ 'io_workers': n,
+                         'max_in_flight': max_in_flight,
+                         'latency': latency,
+                         'seconds': seconds,
+                         'docs': len(docs),
+                         'docs_per_s': len(docs) / seconds if seconds > 0 else None,
+                         'identical': docs == reference
+                         })
+        print('-- ' + str(n) + ' I/O threads: ' + '{:.3f}s'.format(seconds), file=sys.stderr)
+    
+    return results
+
+
+def write_results(results, pout=None):
+    """
+    Write results as JSON to a file, or to standard output if pout is None.
+    """
+    output = json.dumps(results, indent=2)
+    if pout is None:
+        print(output)
+    else:
+        with open(pout, 'w') as fout:
+            fout.write(output)
+        print('-- Wrote benchmark results to file:', pout, file=sys.stderr)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmarks of the eHOST reader and agreement modules.')
+    subparsers = parser.add_subparsers(dest='command')
+    
+    subparsers.add_parser('imports', help='check import times against their limits')
+    
+    generate = subparsers.add_parser('generate', help='write a synthetic eHOST corpus')
+    generate.add_argument('out_dir')
+    generate.add_argument('--docs', type=int, default=100)
+    generate.add_argument('--mentions', type=int, default=20)
+    generate.add_argument('--overlap', type=float, default=0.8)
+    generate.add_argument('--attributes', type=int, default=3)
+    generate.add_argument('--cardinality', type=int, default=3)
+    generate.add_argument('--seed', type=int, default=0)
+    
+    run = subparsers.add_parser('run', help='time the pipeline stages on synthetic corpora')
+    run.add_argument('--scales', type=int, nargs='+', default=[10, 100, 1000])
+    run.add_argument('--mentions', type=int, default=20)
+    run.add_argument('--overlap', type=float, default=0.8)
+    run.add_argument('--attributes', type=int, default=3)
+    run.add_argument('--cardinality', type=int, default=3)
+    run.add_argument('--stages', nargs='+', choices=STAGES, default=STAGES)
+    run.add_argument('--model', default='en_core_web_sm')
+    run.add_argument('--work-dir', default=None)
+    run.add_argument('--seed', type=int, default=0)
+    run.add_argument('--out', default=None, help='JSON output file (standard output if not given)')
+    
+    io_run = subparsers.add_parser('io', help='time loading a corpus with an artificial read latency')
+    io_run.add_argument('ann_dir')
+    io_run.add_argument('--latency', type=float, default=0.005, help='seconds added to each file read')
+    io_run.add_argument('--io-workers', type=int, nargs='+', default=[0, 1, 4, 16])
+    io_run.add_argument('--max-in-flight', type=int, default=32)
+    io_run.add_argument('--out', default=None, help='JSON output file (standard output if not given)')
+    
+    args = parser.parse_args()
+    
+    if args.command == 'generate':
+        ann_dirs = generate_corpus(args.out_dir, args.docs, args.mentions, args.overlap, args.attributes, args.cardinality, seed=args.seed)
+        print(json.dumps(ann_dirs))
+        return 0
+    
+    if args.command == 'run':
+        results = run_benchmarks(args.scales, args.mentions, args.overlap, args.attributes, args.cardinality,
+                                 args.stages, args.model, args.work_dir, args.seed)
+        write_results(results, args.out)
+        return 0
+    
+    if args.command == 'io':
+        results = run_io_benchmark(args.ann_dir, args.latency, args.io_workers, args.max_in_flight)
+        write_results(results, args.out)
+        return 0 if all(result['identical'] for result in results) else 1
+    
+    results, failures = check_import_times()
+    print(json.dumps(results, indent=2))
+    for failure in failures:
+        print(failure, file=sys.stderr)
+    
+    return 1 if len(failures) > 0 else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,268 @@
+# -*- coding: utf-8 -*-
+"""
+Memory-mapped access to the corpus texts (corpus/*.txt) of eHOST projects.
+
+Texts are read as UTF-8 and addressed by character offsets, as mention
+spans are, through a sparse index of the byte offset of every n-th
+character. Only the bytes of the requested spans are decoded, so notes are
+never loaded whole into Python strings. The index is built with NumPy and
+can be kept in an AnnotationCache. Texts in ASCII need no index.
+"""
+
+import csv
+import mmap
+import os
+import sys
+
+from collections import Counter
+from ehost_annotation_cache import init_worker_cache, worker_cache
+from ehost_annotation_reader import get_ehost_text_path, load_mentions_with_attributes, scan_corpus
+from multiprocessing import Pool
+
+
+INDEX_STEP = 64
+
+
+def build_char_index(data, step=INDEX_STEP, chunk_size=16 * 1024 * 1024):
+    """
+    Index the byte offsets of every step-th character of UTF-8 encoded data
+    (bytes or a memory map), i.e. of characters 0, step, 2 * step, ...
+    Return the number of characters and the index as a NumPy array, or None
+    for the index if the data is ASCII and byte offsets are character
+    offsets.
+    """
+    import numpy as np
+
+    size = len(data)
+    buf = np.frombuffer(data, dtype=np.uint8) if size > 0 else np.zeros(0, dtype=np.uint8)
+
+    checkpoints = []
+    n_chars = 0
+    for i in range(0, size, chunk_size):
+        # Characters start at every byte that is not a continuation byte
+        starts = np.flatnonzero((buf[i:i + chunk_size] & 0xC0) != 0x80) + i
+        checkpoints.append(starts[(-n_chars) % step::step])
+        n_chars += len(starts)
+
+    if n_chars == size:
+        return n_chars, None
+
+    return n_chars, np.concatenate(checkpoints).astype(np.int64)
+
+
+class CorpusText(object):
+    """
+    Read-only, memory-mapped UTF-8 text addressed by character offsets.
+    pin: path of the text file
+    cache: optional AnnotationCache to keep the character index in
+    step: number of characters between indexed byte offsets
+    """
+
+    def __init__(self, pin, cache=None, step=INDEX_STEP):
+        self.pin = pin
+        self.step = step
+        self._file = open(pin, 'rb')
+        self.size = os.fstat(self._file.fileno()).st_size
+        if self.size > 0:
+            self._data = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        else:
+            # Empty files cannot be mapped
+            self._data = b''
+
+        index = None
+        if cache is not None:
+            index = cache.get(pin, 'char_index_' + str(step))
+        if index is None:
+            index = build_char_index(self._data, step)
+            if cache is not None:
+                cache.put(pin, 'char_index_' + str(step), index)
+        self.n_chars, self.index = index
+
+    def __len__(self):
+        return self.n_chars
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+        return False
+
+    def byte_offset(self, offset):
+        """
+        Return the byte offset of a character offset (0 to len(self)).
+        """
+        if offset < 0 or offset > self.n_chars:
+            raise IndexError('-- Character offset ' + str(offset) + ' out of range in ' + self.pin)
+        if self.index is None or offset == self.n_chars:
+            return offset if self.index is None else self.size
+
+        k = offset // self.step
+        pos = int(self.index[k])
+        data = self._data
+        for _ in range(offset - k * self.step):
+            pos += 1
+            while pos < self.size and (data[pos] & 0xC0) == 0x80:
+                pos += 1
+
+        return pos
+
+    def slice(self, start, end):
+        """
+        Return the text between two character offsets.
+        """
+        return self._data[self.byte_offset(start):self.byte_offset(end)].decode('utf-8', errors='replace')
+
+    def close(self):
+        if isinstance(self._data, mmap.mmap):
+            self._data.close()
+        self._data = b''
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+
+def find_drift(text, expected, start, end, max_drift):
+    """
+    Look for the text of a mention within max_drift characters of its span.
+    Return the shift of the closest occurrence from the annotated start, or
+    None if there is none.
+    """
+    w_start = max(0, start - max_drift)
+    w_end = min(len(text), end + max_drift)
+    window = text.slice(w_start, w_end)
+
+    drift = None
+    i = window.find(expected)
+    while i >= 0:
+        shift = w_start + i - start
+        if drift is None or abs(shift) < abs(drift):
+            drift = shift
+        i = window.find(expected, i + 1)
+
+    return drift
+
+
+def validate_file_spans(args):
+    """
+    Check that the text of every mention of an annotation file is found in
+    the corpus text at its span. Takes a (file, cache, max_drift) tuple, to
+    be run in worker processes.
+    Return the file, a Counter of statuses, a list of problems, i.e. (file,
+    mention id, start, end, status, drift, annotated text, text at span)
+    tuples, and the cache hits and misses.
+    Statuses are 'ok', 'drift' (the text is found nearby), 'mismatch' (it
+    is not), 'out_of_range' (the span is not within the text) and
+    'missing_text' (the corpus text of the file is missing).
+    """
+    pin, cache, max_drift = args
+    if cache is None:
+        cache = worker_cache()
+    hits = misses = 0
+    if cache is not None:
+        hits, misses = cache.hits, cache.misses
+
+    statuses = Counter()
+    problems = []
+    mentions = load_mentions_with_attributes(pin, cache=cache)[pin]
+
+    text = None
+    try:
+        text = CorpusText(get_ehost_text_path(pin), cache=cache)
+    except (AssertionError, OSError):
+        if len(mentions) > 0:
+            statuses['missing_text'] += len(mentions)
+        problems.append((pin, None, None, None, 'missing_text', None, None, None))
+
+    if text is not None:
+        with text:
+            for mention_id, mention in mentions.items():
+                start = int(mention['start'])
+                end = int(mention['end'])
+                expected = mention['text']
+                if start < 0 or end < start or end > len(text):
+                    status, drift, found = 'out_of_range', None, None
+                else:
+                    found = text.slice(start, end)
+                    drift = None
+                    if expected is None or found == expected:
+                        status = 'ok'
+                    else:
+                        drift = find_drift(text, expected, start, end, max_drift)
+                        status = 'mismatch' if drift is None else 'drift'
+                statuses[status] += 1
+                if status != 'ok':
+                    problems.append((pin, mention_id, start, end, status, drift, expected, found))
+
+    if cache is not None:
+        hits, misses = cache.hits - hits, cache.misses - misses
+
+    return pin, statuses, problems, (hits, misses)
+
+
+SPAN_REPORT_COLUMNS = ['file', 'mention_id', 'start', 'end', 'status', 'drift', 'annotated_text', 'text_at_span']
+
+
+def validate_spans(main_dir, pout=None, max_drift=20, workers=1, cache=None):
+    """
+    Check the spans of all mentions of a corpus against its texts, in
+    parallel, and report offset drift.
+    main_dir: corpus base directory
+    pout: optional CSV file to save the problems to, one row per mention
+    max_drift: number of characters around a span in which to look for the annotated text
+    workers: number of processes (on platforms that spawn processes, call from within an if __name__ == '__main__' block)
+    cache: optional AnnotationCache for the parsed mentions and character indexes
+    Return a dictionary with the number of mentions per status, the
+    number of drifted mentions per drift, the files with problems and the
+    list of problems (see validate_file_spans()).
+    """
+    files = scan_corpus(main_dir, 'xml', suffix='knowtator.xml')
+    pool = None
+    if workers > 1 and len(files) > 0:
+        # The cache is sent to each process once, not with every file
+        pool = Pool(processes=workers, initializer=init_worker_cache, initargs=(cache,))
+        results = pool.imap(validate_file_spans, [(f, None, max_drift) for f in files], max(1, len(files) // (4 * workers)))
+    else:
+        results = map(validate_file_spans, [(f, cache, max_drift) for f in files])
+
+    statuses = Counter()
+    drifts = Counter()
+    problem_files = []
+    problems = []
+    try:
+        for pin, file_statuses, file_problems, cache_stats in results:
+            statuses.update(file_statuses)
+            if len(file_problems) > 0:
+                problem_files.append(pin)
+            for problem in file_problems:
+                if problem[4] == 'drift':
+                    drifts[problem[5]] += 1
+            problems += file_problems
+            if pool is not None and cache is not None:
+                cache.add_stats(*cache_stats)
+    finally:
+        if pool is not None:
+            # Stops the workers still running if an error occurred
+            pool.terminate()
+            pool.join()
+
+    if pout is not None:
+        with open(pout, 'w', newline='', encoding='utf-8') as output:
+            writer = csv.writer(output)
+            writer.writerow(SPAN_REPORT_COLUMNS)
+            writer.writerows(problems)
+        print('-- Wrote span report to file:', pout, file=sys.stderr)
+
+    print('-- Checked ' + str(sum(statuses.values())) + ' mentions in ' + str(len(files)) + ' files: ' +
+          ', '.join(status + ' ' + str(statuses[status]) for status in sorted(statuses)), file=sys.stderr)
+    if len(drifts) > 0:
+        print('-- Most common drifts: ' + ', '.join(str(d) + ' (' + str(n) + ')' for d, n in drifts.most_common(5)), file=sys.stderr)
+
+    if cache is not None:
+        print(cache.report(), file=sys.stderr)
+
+    return { 'statuses': dict(statuses),
+             'drifts': dict(drifts),
+             'files': problem_files,
+             'problems': problems
+             }
@@ -0,0 +1,190 @@
+# -*- coding: utf-8 -*-
+"""
+Compact columnar storage of the mentions of a whole corpus.
+
+Offsets are kept in int32 arrays, classes, annotators and attribute names
+and values are interned in a single string table, and attributes are held
+in a sparse table indexed by mention. Read access goes through read-only
+mapping views, so the store can be used wherever the nested dictionaries
+returned by batch_process_directory() are expected.
+"""
+
+from array import array
+from collections.abc import Mapping
+
+
+BASE_FIELDS = ('class', 'text', 'annotator', 'start', 'end', 'comment')
+
+
+class MentionStore(Mapping):
+    """
+    Mapping of file keys to the mentions of each file, equivalent to
+    {file: {mention_id: {'class': ..., 'start': ..., attr: value}}}.
+    """
+
+    def __init__(self):
+        self.strings = []
+        self._codes = {}
+
+        self._files = {}
+        self._file_keys = []
+        self._file_start = array('i')
+        self._file_end = array('i')
+
+        self.mention_ids = []
+        self.classes = array('i')
+        self.texts = []
+        self.annotators = array('i')
+        self.starts = array('i')
+        self.ends = array('i')
+        self.comments = {}
+
+        # Sparse attribute table: the attributes of mention i are held in
+        # rows attr_ptr[i] to attr_ptr[i + 1]
+        self.attr_ptr = array('i', [0])
+        self.attr_names = array('i')
+        self.attr_values = array('i')
+
+    def intern(self, s):
+        """
+        Return the code of a string in the string table (-1 for None).
+        """
+        if s is None:
+            return -1
+        code = self._codes.get(s, None)
+        if code is None:
+            code = len(self.strings)
+            self._codes[s] = code
+            self.strings.append(s)
+        return code
+
+    def string(self, code):
+        if code < 0:
+            return None
+        return self.strings[code]
+
+    def add_file(self, key, mentions):
+        """
+        Append the mentions of a file, as returned for that key by
+        load_mentions_with_attributes(). Adding a key that is already stored
+        replaces its mentions, as dict.update() would.
+        """
+        first = len(self.mention_ids)
+        for mention_id, mention in mentions.items():
+            i = len(self.mention_ids)
+            self.mention_ids.append(mention_id)
+            self.classes.append(self.intern(mention.get('class', None)))
+            self.texts.append(mention.get('text', None))
+            self.annotators.append(self.intern(mention.get('annotator', None)))
+            self.starts.append(int(mention['start']))
+            self.ends.append(int(mention['end']))
+            comment = mention.get('comment', None)
+            if comment is not None:
+                self.comments[i] = comment
+            for attr, val in mention.items():
+                if attr not in BASE_FIELDS:
+                    self.attr_names.append(self.intern(attr))
+                    self.attr_values.append(self.intern(val))
+            self.attr_ptr.append(len(self.attr_names))
+
+        if key in self._files:
+            n = self._files[key]
+            self._file_start[n] = first
+            self._file_end[n] = len(self.mention_ids)
+        else:
+            self._files[key] = len(self._file_keys)
+            self._file_keys.append(key)
+            self._file_start.append(first)
+            self._file_end.append(len(self.mention_ids))
+
+    def attributes(self, i):
+        """
+        Return the (attribute, value) pairs of mention i.
+        """
+        return [(self.strings[self.attr_names[j]], self.strings[self.attr_values[j]]) for j in range(self.attr_ptr[i], self.attr_ptr[i + 1])]
+
+    def __getitem__(self, key):
+        n = self._files[key]
+        return FileMentions(self, self._file_start[n], self._file_end[n])
+
+    def __iter__(self):
+        return iter(self._file_keys)
+
+    def __len__(self):
+        return len(self._file_keys)
+
+    def to_dict(self):
+        """
+        Convert the store back to nested dictionaries.
+        """
+        return { key: { mention_id: dict(mention) for mention_id, mention in self[key].items() } for key in self }
+
+
+class FileMentions(Mapping):
+    """
+    Read-only view of the mentions of one file, keyed by mention id.
+    """
+
+    __slots__ = ('_store', '_first', '_last', '_index')
+
+    def __init__(self, store, first, last):
+        self._store = store
+        self._first = first
+        self._last = last
+        self._index = None
+
+    def __getitem__(self, mention_id):
+        if self._index is None:
+            self._index = { self._store.mention_ids[i]: i for i in range(self._first, self._last) }
+        return MentionView(self._store, self._index[mention_id])
+
+    def __iter__(self):
+        return iter(self._store.mention_ids[self._first:self._last])
+
+    def __len__(self):
+        return self._last - self._first
+
+
+class MentionView(Mapping):
+    """
+    Read-only dictionary view of a single mention. Offsets are returned as
+    strings, as in the dictionaries built from the XML.
+    """
+
+    __slots__ = ('_store', '_i')
+
+    def __init__(self, store, i):
+        self._store = store
+        self._i = i
+
+    def __getitem__(self, field):
+        store = self._store
+        i = self._i
+        if field == 'class':
+            return store.string(store.classes[i])
+        if field == 'text':
+            return store.texts[i]
+        if field == 'annotator':
+            return store.string(store.annotators[i])
+        if field == 'start':
+            return str(store.starts[i])
+        if field == 'end':
+            return str(store.ends[i])
+        if field == 'comment':
+            return store.comments.get(i, None)
+        for attr, val in store.attributes(i):
+            if attr == field:
+                return val
+        raise KeyError(field)
+
+    def __iter__(self):
+        for field in BASE_FIELDS:
+            yield field
+        for attr, _ in self._store.attributes(self._i):
+            yield attr
+
+    def __len__(self):
+        return len(BASE_FIELDS) + self._store.attr_ptr[self._i + 1] - self._store.attr_ptr[self._i]
+
+    def __repr__(self):
+        return repr(dict(self))
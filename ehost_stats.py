@@ -0,0 +1,189 @@
+# -*- coding: utf-8 -*-
+"""
+Timers and counters for the reader and agreement pipelines.
+
+Functions that accept a stats argument add to the PipelineStats object they
+are given, and skip all instrumentation when it is None. Stage times are
+exclusive: time spent in a stage entered within another one (e.g. parsing
+a file during span matching) is only counted for the inner stage.
+"""
+
+import cProfile
+import io
+import json
+import pstats
+import time
+import tracemalloc
+
+from collections import Counter
+
+
+class PipelineStats(object):
+    """
+    Counters (e.g. files listed, bytes parsed, mentions loaded, pairs
+    compared, matches found) and time per stage of a run.
+    profile: names of stages to run under cProfile
+    trace_memory: names of stages whose peak memory allocation (above the memory in use when the stage is entered) is traced with tracemalloc
+    Profiling and memory tracing only cover stages run in the calling
+    process, not in worker processes.
+    """
+
+    def __init__(self, profile=(), trace_memory=()):
+        self.counters = Counter()
+        self.seconds = Counter()
+        self.calls = Counter()
+        self.peak_memory = {}
+        self.profile_stages = set(profile)
+        self.trace_memory_stages = set(trace_memory)
+        self._profiles = {}
+        self._stack = []
+        self._tracing = False
+
+    def count(self, name, n=1):
+        """
+        Add n to a counter.
+        """
+        self.counters[name] += n
+
+    def start(self, name):
+        """
+        Enter a stage, pausing the stage it is entered from.
+        """
+        now = time.perf_counter()
+        if len(self._stack) > 0:
+            self._pause(self._stack[-1], now)
+
+        frame = { 'name': name, 'start': now, 'profile': None, 'base': 0, 'peak': 0 }
+        if name in self.trace_memory_stages:
+            if not tracemalloc.is_tracing():
+                tracemalloc.start()
+                self._tracing = True
+            tracemalloc.reset_peak()
+            frame['base'] = frame['peak'] = tracemalloc.get_traced_memory()[0]
+        if name in self.profile_stages:
+            frame['profile'] = self._profiles.setdefault(name, cProfile.Profile())
+            frame['profile'].enable()
+
+        self._stack.append(frame)
+        self.calls[name] += 1
+
+    def stop(self):
+        """
+        Leave the current stage and resume the one it was entered from.
+        """
+        frame = self._stack.pop()
+        now = time.perf_counter()
+        self._pause(frame, now)
+
+        name = frame['name']
+        if name in self.trace_memory_stages:
+            self.peak_memory[name] = max(self.peak_memory.get(name, 0), frame['peak'] - frame['base'])
+
+        if len(self._stack) == 0:
+            if self._tracing:
+                # Only stop tracing started here
+                tracemalloc.stop()
+                self._tracing = False
+        else:
+            parent = self._stack[-1]
+            parent['peak'] = max(parent['peak'], frame['peak'])
+            parent['start'] = now
+            if parent['profile'] is not None:
+                parent['profile'].enable()
+            if parent['name'] in self.trace_memory_stages and tracemalloc.is_tracing():
+                tracemalloc.reset_peak()
+
+    def _pause(self, frame, now):
+        self.seconds[frame['name']] += now - frame['start']
+        if frame['profile'] is not None:
+            frame['profile'].disable()
+        if frame['name'] in self.trace_memory_stages and tracemalloc.is_tracing():
+            frame['peak'] = max(frame['peak'], tracemalloc.get_traced_memory()[1])
+
+    def stage(self, name):
+        """
+        Context manager timing a stage, i.e. with stats.stage('parsing'): ...
+        """
+        return StageTimer(self, name)
+
+    def merge(self, other):
+        """
+        Add the counters and stage times of another PipelineStats object or
+        of its to_dict() output, e.g. from a worker process.
+        """
+        if isinstance(other, PipelineStats):
+            other = other.to_dict()
+        self.counters.update(other['counters'])
+        for name, stage in other['stages'].items():
+            self.seconds[name] += stage['seconds']
+            self.calls[name] += stage['calls']
+            if 'peak_memory_bytes' in stage:
+                self.peak_memory[name] = max(self.peak_memory.get(name, 0), stage['peak_memory_bytes'])
+
+    def to_dict(self):
+        """
+        Return the counters and stages as a dictionary that can be saved as
+        JSON.
+        """
+        stages = {}
+        for name in self.calls:
+            stages[name] = { 'seconds': self.seconds[name], 'calls': self.calls[name] }
+            if name in self.peak_memory:
+                stages[name]['peak_memory_bytes'] = self.peak_memory[name]
+
+        return { 'counters': dict(self.counters), 'stages': stages }
+
+    def to_json(self, pout=None):
+        """
+        Return the stats as a JSON string, and save it to pout if given.
+        """
+        s = json.dumps(self.to_dict(), indent=2, sort_keys=True)
+        if pout is not None:
+            with open(pout, 'w') as output:
+                output.write(s)
+        return s
+
+    def profile_report(self, name, sort='cumulative', limit=30):
+        """
+        Return the cProfile statistics of a profiled stage as text.
+        """
+        profile = self._profiles.get(name, None)
+        if profile is None:
+            return ''
+
+        stream = io.StringIO()
+        pstats.Stats(profile, stream=stream).sort_stats(sort).print_stats(limit)
+
+        return stream.getvalue()
+
+    def report(self):
+        """
+        Return a summary of the stage times and counters, one per line.
+        """
+        lines = []
+        for name, seconds in self.seconds.most_common():
+            line = '-- Stage ' + name + ': ' + '{:.3f}'.format(seconds) + 's (' + str(self.calls[name]) + ' calls)'
+            if name in self.peak_memory:
+                line += ', peak memory ' + '{:.1f}'.format(self.peak_memory[name] / (1024.0 * 1024.0)) + ' MB'
+            lines.append(line)
+        for name in sorted(self.counters):
+            lines.append('-- ' + name + ': ' + str(self.counters[name]))
+
+        return '\n'.join(lines)
+
+
+class StageTimer(object):
+
+    __slots__ = ('stats', 'name')
+
+    def __init__(self, stats, name):
+        self.stats = stats
+        self.name = name
+
+    def __enter__(self):
+        self.stats.start(self.name)
+        return self.stats
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stats.stop()
+        return False
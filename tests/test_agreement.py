@@ -0,0 +1,239 @@
+# -*- coding: utf-8 -*-
+
+import os
+import random
+
+import pytest
+
+import ehost_agreement as ea
+
+from ehost_benchmark import write_annotation_file
+
+
+TEXT = 'patient reports low mood and poor sleep since last review'
+
+
+def write_project(base, annotator, mentions, text=TEXT, text_name='note_000001.txt'):
+    """
+    Write a one-document eHOST project for an annotator and return its
+    directory. Mentions are (start, end, class, attributes) tuples.
+    """
+    d = os.path.join(str(base), annotator)
+    patient = os.path.join(d, 'patient_00001')
+    for subdir in ['config', 'corpus', 'saved']:
+        os.makedirs(os.path.join(patient, subdir), exist_ok=True)
+    with open(os.path.join(patient, 'corpus', text_name), 'w', encoding='utf-8') as output:
+        output.write(text)
+    write_annotation_file(os.path.join(patient, 'saved', text_name + '.knowtator.xml'), text_name, annotator, text, mentions)
+
+    return d
+
+
+def test_prf_no_true_positives():
+    assert ea.prf(0.0, 2.0, 2.0) == (0.0, 0.0, 0.0)
+    assert ea.prf(0.0, 0.0, 0.0) == (0.0, 0.0, 0.0)
+
+
+def test_swapped_classes(tmp_path):
+    # Both annotators mark the same two spans with swapped classes, so
+    # neither class has a true positive
+    dir1 = write_project(tmp_path, 'A', [(0, 7, 'X', []), (16, 24, 'Y', [])])
+    dir2 = write_project(tmp_path, 'B', [(0, 7, 'Y', []), (16, 24, 'X', [])])
+
+    results = ea.batch_agreement(('A', dir1), ('B', dir2), report_dir=str(tmp_path), print_report=False)
+
+    assert results['spans']['f-score'] == 1.0
+    for c in ['X', 'Y']:
+        scores = results['classes'][c]
+        assert (scores['tp'], scores['fp'], scores['fn']) == (0, 1, 1)
+        assert scores['f-score'] == 0.0
+    assert results['class_confusion'] == { 'labels': ['X', 'Y'], 'matrix': [[0, 1], [1, 0]] }
+
+
+def test_report_removed_on_error(tmp_path, monkeypatch):
+    dir1 = write_project(tmp_path, 'A', [(0, 7, 'X', [])])
+    dir2 = write_project(tmp_path, 'B', [(0, 7, 'X', [])])
+
+    def fail(class_pairs):
+        raise RuntimeError('failed')
+
+    monkeypatch.setattr(ea, 'class_prf', fail)
+    try:
+        ea.batch_agreement(('A', dir1), ('B', dir2), report_dir=str(tmp_path), print_report=False)
+    except RuntimeError:
+        pass
+    else:
+        raise AssertionError('the error was not raised')
+
+    assert not os.path.exists(os.path.join(str(tmp_path), 'agreement_report_A_B.txt'))
+
+
+def random_tags(rnd, n, max_offset=30, malformed=0.0):
+    """
+    Random mentions on a short text, so that many spans overlap or are
+    duplicated. A rate of them have their end before their start.
+    """
+    tags = []
+    for _ in range(n):
+        start = rnd.randrange(max_offset)
+        end = start + rnd.randrange(6)
+        if rnd.random() < malformed:
+            start, end = end + 1, start
+        tags.append({ 'start': str(start), 'end': str(end), 'text': 't' + str(rnd.randrange(3)), 'class': rnd.choice(['X', 'Y']) })
+
+    return tags
+
+
+def reference_counts(tags1, tags2, matching):
+    """
+    tp, fp and fn from the pairwise comparison of all mentions.
+    """
+    pairs = ea.match_spans_pairwise(tags1, tags2, matching)
+    matched = set()
+    for i, j, _ in pairs:
+        matched.add(ea.match_key(tags1[i]))
+        matched.add(ea.match_key(tags2[j]))
+    fn = sum(1 for tag in tags1 if ea.match_key(tag) not in matched)
+    fp = sum(1 for tag in tags2 if ea.match_key(tag) not in matched)
+
+    return len(pairs), fp, fn
+
+
+def test_find_span_matches_pairwise():
+    rnd = random.Random(0)
+    for _ in range(300):
+        tags1 = random_tags(rnd, rnd.randrange(12))
+        tags2 = random_tags(rnd, rnd.randrange(12))
+        spans1 = [(int(tag['start']), int(tag['end'])) for tag in tags1]
+        spans2 = [(int(tag['start']), int(tag['end'])) for tag in tags2]
+        for matching in ['strict', 'relaxed']:
+            matches = [(i, j) for i, j in enumerate(ea.find_span_matches(spans1, spans2, matching)) if j is not None]
+            expected = [(i, j) for i, j, _ in ea.match_spans_pairwise(tags1, tags2, matching)]
+            assert matches == expected
+
+
+def test_count_agreements_pairwise():
+    rnd = random.Random(1)
+    for k in range(300):
+        # Every other document has malformed spans
+        malformed = 0.2 if k % 2 else 0.0
+        tags1 = random_tags(rnd, rnd.randrange(12), malformed=malformed)
+        tags2 = random_tags(rnd, rnd.randrange(12), malformed=malformed)
+        docs = { 'f1': { 'f1': dict(enumerate(tags1)) }, 'f2': { 'f2': dict(enumerate(tags2)) } }
+        for matching in ['strict', 'relaxed']:
+            tp, fp, fn = ea.count_agreements('f1', 'f2', '', matching, docs)[:3]
+            assert (tp, fp, fn) == reference_counts(tags1, tags2, matching)
+
+
+def test_multi_agreement_ordered_pairs(tmp_path):
+    # A's mention matches both of B's: with A as the reference one of them
+    # is spurious, with B as the reference both are matched
+    ann_dirs = [('A', write_project(tmp_path, 'A', [(0, 30, 'X', [('polarity', 'positive')])])),
+                ('B', write_project(tmp_path, 'B', [(0, 7, 'X', [('polarity', 'positive')]), (16, 24, 'X', [('polarity', 'negative')])])),
+                ('C', write_project(tmp_path, 'C', [(16, 24, 'Y', [('polarity', 'negative')])]))]
+
+    results = ea.batch_multi_agreement(ann_dirs)
+
+    assert results['annotators'] == ['A', 'B', 'C']
+    for i in range(3):
+        for j in range(3):
+            if i == j:
+                assert results['f-score'][i][j] == 1.0
+                continue
+            pair = ea.batch_agreement(ann_dirs[i], ann_dirs[j], print_report=False)
+            assert results['precision'][i][j] == pair['spans']['precision']
+            assert results['recall'][i][j] == pair['spans']['recall']
+            assert results['f-score'][i][j] == pair['spans']['f-score']
+            k = pair['attributes']['polarity']['kappa']
+            assert results['kappa']['polarity'][i][j] == k or (k != k and results['kappa']['polarity'][i][j] != results['kappa']['polarity'][i][j])
+    assert results['precision'][0][1] == 0.5
+    assert results['precision'][1][0] == results['recall'][1][0] == 1.0
+
+
+def test_align_spans():
+    a = [{ 'start': '0', 'end': '5' }, { 'start': '10', 'end': '15' }]
+    b = [{ 'start': '3', 'end': '8' }, { 'start': '10', 'end': '15' }]
+    c = [{ 'start': '0', 'end': '5' }, { 'start': '20', 'end': '25' }]
+
+    relaxed = ea.align_spans([a, b, c], 'relaxed')
+    assert relaxed == [[a[0], b[0], c[0]], [a[1], b[1], None], [None, None, c[1]]]
+
+    strict = ea.align_spans([a, b, c], 'strict')
+    assert strict == [[a[0], None, c[0]], [None, b[0], None], [a[1], b[1], None], [None, None, c[1]]]
+
+
+def test_fleiss_kappa():
+    # Example of Fleiss (1971) as given on Wikipedia: 10 items rated by 14
+    # raters into 5 categories
+    counts = [[0, 0, 0, 0, 14], [0, 2, 6, 4, 2], [0, 0, 3, 5, 6], [0, 3, 9, 2, 0], [2, 2, 8, 1, 1],
+              [7, 7, 0, 0, 0], [3, 2, 6, 3, 0], [2, 5, 3, 2, 2], [6, 5, 2, 1, 0], [0, 2, 2, 3, 7]]
+    ratings = [[c for c, n in enumerate(item) for _ in range(n)] for item in counts]
+
+    assert abs(ea.fleiss_kappa(ratings) - 0.20993) < 1e-5
+    assert ea.fleiss_kappa([['X', 'X'], ['Y', 'Y']]) == 1.0
+    assert ea.fleiss_kappa([]) != ea.fleiss_kappa([])
+    # Chance agreement is perfect if every rating is the same
+    assert ea.fleiss_kappa([['X', 'X'], ['X', 'X']]) != ea.fleiss_kappa([['X', 'X'], ['X', 'X']])
+
+
+def test_attribute_metrics_sklearn():
+    metrics = pytest.importorskip('sklearn.metrics')
+
+    rnd = random.Random(2)
+    for k in range(200):
+        n = rnd.randrange(1, 60)
+        values = ['v' + str(i) for i in range(rnd.randrange(1, 6))]
+        if k % 2:
+            # Missing values, read as None
+            values.append(None)
+        vals1 = [{ 'a': rnd.choice(values) } for _ in range(n)]
+        vals2 = [{ 'a': v['a'] if rnd.random() < 0.6 else rnd.choice(values) } for v in vals1]
+        confusion = ea.attribute_confusion_matrices(vals1, vals2, ['a'])['a'][1]
+
+        # None is the first label, as the empty string is for scikit-learn
+        y1 = [v['a'] or '' for v in vals1]
+        y2 = [v['a'] or '' for v in vals2]
+        for average in ['macro', 'micro']:
+            expected = metrics.precision_recall_fscore_support(y1, y2, average=average, zero_division=0)[:3]
+            assert ea.confusion_prf(confusion, average) == tuple(float(x) for x in expected)
+        kappa = ea.confusion_kappa(confusion)
+        expected = metrics.cohen_kappa_score(y1, y2)
+        assert kappa == expected or (kappa != kappa and expected != expected)
+
+
+def test_incremental_rescoring(tmp_path):
+    from ehost_annotation_cache import PairResultStore
+
+    rnd = random.Random(3)
+    for annotator in ['A', 'B']:
+        for n in range(6):
+            mentions = [(s, s + rnd.randrange(1, 8), rnd.choice(['X', 'Y']), [('polarity', rnd.choice(['positive', 'negative']))])
+                        for s in sorted(rnd.sample(range(50), 4))]
+            dir_ann = write_project(tmp_path, annotator, mentions, text_name='note_' + str(n).zfill(6) + '.txt')
+        if annotator == 'A':
+            dir1 = dir_ann
+        else:
+            dir2 = dir_ann
+    store = PairResultStore(str(tmp_path / 'store'))
+
+    def run(name, results_store):
+        report_dir = tmp_path / name
+        report_dir.mkdir()
+        results = ea.batch_agreement(('A', dir1), ('B', dir2), report_dir=str(report_dir), print_report=False, results_store=results_store, bootstrap=50, seed=0)
+        with open(str(report_dir / 'agreement_report_A_B.txt')) as f:
+            return results, f.read()
+
+    run('first', store)
+
+    saved = os.path.join(dir2, 'patient_00001', 'saved')
+    # Rewrite one file with other mentions, touch another and delete a third
+    write_annotation_file(os.path.join(saved, 'note_000001.txt.knowtator.xml'), 'note_000001.txt', 'B', TEXT, [(0, 7, 'Y', [('polarity', 'negative')])])
+    st = os.stat(os.path.join(saved, 'note_000002.txt.knowtator.xml'))
+    os.utime(os.path.join(saved, 'note_000002.txt.knowtator.xml'), ns=(st.st_atime_ns, st.st_mtime_ns + 10 ** 9))
+    os.remove(os.path.join(saved, 'note_000003.txt.knowtator.xml'))
+
+    hits = store.hits
+    incremental = run('incremental', store)
+    assert store.hits - hits == 3
+
+    assert incremental == run('full', None)
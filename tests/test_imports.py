@@ -0,0 +1,13 @@
+# -*- coding: utf-8 -*-
+
+import pytest
+
+from ehost_benchmark import IMPORT_LIMITS, import_time
+
+
+@pytest.mark.parametrize('module', sorted(IMPORT_LIMITS))
+def test_no_heavy_imports(module):
+    # Imported in a fresh interpreter, as by worker processes
+    result = import_time(module, repeat=1)
+
+    assert result['loaded'] == [], module + ' loads ' + ', '.join(result['loaded']) + ' at import time'